@@ -1,3 +1,5 @@
+from functools import lru_cache
+
 from aiogram.types import (
     ReplyKeyboardMarkup,
     KeyboardButton,
@@ -5,6 +7,8 @@ from aiogram.types import (
     InlineKeyboardButton
 )
 
+from app.options import options_to_mask, mask_to_options
+
 def main_menu():
     keyboard = ReplyKeyboardMarkup(
         keyboard=[
@@ -136,18 +140,29 @@ def payment_approval_buttons(user_id, order_id):
     return keyboard
 
 def admin_order_actions(order_id, statuses):
+    # Разметка кэшируется по (order_id, статусы кнопок) — повторные отрисовки её не создают
+    return _admin_order_actions(
+        order_id,
+        statuses.get('ready', False),
+        statuses.get('sent', False),
+        statuses.get('delivered', False)
+    )
+
+
+@lru_cache(maxsize=256)
+def _admin_order_actions(order_id, ready, sent, delivered):
     buttons = []
 
-    ready_text = '🛠️ Готово до відправки ✅' if statuses.get('ready', False) else '🛠️ Готово до відправки'
+    ready_text = '🛠️ Готово до відправки ✅' if ready else '🛠️ Готово до відправки'
     buttons.append([InlineKeyboardButton(text=ready_text, callback_data=f'order_ready_{order_id}')])
 
     # КНОПКА "Створити ТТН"
     buttons.append([InlineKeyboardButton(text='Створити ТТН', callback_data=f'order_create_ttn_{order_id}')])
 
-    sent_text = '📦 Відправлено ✅' if statuses.get('sent', False) else '📦 Відправлено'
+    sent_text = '📦 Відправлено ✅' if sent else '📦 Відправлено'
     buttons.append([InlineKeyboardButton(text=sent_text, callback_data=f'order_sent_{order_id}')])
 
-    delivered_text = '✅ Доставлено ✅' if statuses.get('delivered', False) else '✅ Доставлено'
+    delivered_text = '✅ Доставлено ✅' if delivered else '✅ Доставлено'
     buttons.append([InlineKeyboardButton(text=delivered_text, callback_data=f'order_delivered_{order_id}')])
 
     buttons.append([InlineKeyboardButton(text='❌ Відхилити замовлення', callback_data=f'order_cancel_{order_id}')])
@@ -155,32 +170,6 @@ def admin_order_actions(order_id, statuses):
     keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
     return keyboard
 
-    # Sent
-    if statuses.get('sent', False):
-        sent_text = '📦 Відправлено ✅'
-    else:
-        sent_text = '📦 Відправлено'
-    buttons.append([
-        InlineKeyboardButton(text=sent_text,
-                             callback_data=f'order_sent_{order_id}')
-    ])
-    # Delivered
-    if statuses.get('delivered', False):
-        delivered_text = '✅ Доставлено ✅'
-    else:
-        delivered_text = '✅ Доставлено'
-    buttons.append([
-        InlineKeyboardButton(text=delivered_text,
-                             callback_data=f'order_delivered_{order_id}')
-    ])
-    # Reject order
-    buttons.append([
-        InlineKeyboardButton(text='❌ Відхилити замовлення',
-                             callback_data=f'order_cancel_{order_id}')
-    ])
-    keyboard = InlineKeyboardMarkup(inline_keyboard=buttons)
-    return keyboard
-
 
 def admin_orders_menu():
     keyboard = ReplyKeyboardMarkup(
@@ -194,6 +183,19 @@ def admin_orders_menu():
     return keyboard
 
 
+def admin_orders_pagination(view, first_id, last_id, has_prev, has_next):
+    # view — 'processing' или 'completed'; страницы считаются от id крайних заказов
+    row = []
+    if has_prev:
+        row.append(InlineKeyboardButton(text='⬅️ Попередня', callback_data=f'admin_page_{view}_prev_{first_id}'))
+    if has_next:
+        row.append(InlineKeyboardButton(text='Наступна ➡️', callback_data=f'admin_page_{view}_next_{last_id}'))
+    if not row:
+        return None
+    keyboard = InlineKeyboardMarkup(inline_keyboard=[row])
+    return keyboard
+
+
 def order_details_button(order_id):
     keyboard = InlineKeyboardMarkup(inline_keyboard=[
         [
@@ -222,9 +224,29 @@ def product_display_keyboard(
         category,
         selected_options
 ):
-    from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+    # Разметка зависит только от этих аргументов, поэтому готовые клавиатуры
+    # берутся из LRU-кэша; опции кодируются маской, чтобы ключ был хэшируемым
+    return _product_display_keyboard(
+        current_index,
+        total_products,
+        current_color_index,
+        total_colors,
+        category,
+        options_to_mask(selected_options)
+    )
 
+
+@lru_cache(maxsize=512)
+def _product_display_keyboard(
+        current_index,
+        total_products,
+        current_color_index,
+        total_colors,
+        category,
+        options_mask
+):
     keyboard = InlineKeyboardMarkup(inline_keyboard=[])
+    selected_options = mask_to_options(options_mask)
 
     # ----- 1) Ряд навигации по моделям
     keyboard.inline_keyboard.append([
@@ -0,0 +1,117 @@
+# app/catalog.py
+
+import json
+import os
+import logging
+import re
+import tempfile
+
+# Определяем путь относительно текущего файла
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+PRODUCTS_JSON_PATH = os.path.join(BASE_DIR, 'products.json')
+
+# Предыдущие версии каталога для мгновенного отката
+SNAPSHOTS_DIR = os.path.join(BASE_DIR, 'catalog_snapshots')
+SNAPSHOTS_TO_KEEP = 5
+
+CATEGORIES = ('t_shirts', 'hoodies')
+
+logger = logging.getLogger(__name__)
+
+
+def _snapshot_path(version):
+    return os.path.join(SNAPSHOTS_DIR, f'products.v{version}.json')
+
+
+def list_versions():
+    """
+    Возвращает сохранённые версии каталога по возрастанию.
+    """
+    if not os.path.isdir(SNAPSHOTS_DIR):
+        return []
+    versions = []
+    for name in os.listdir(SNAPSHOTS_DIR):
+        match = re.fullmatch(r'products\.v(\d+)\.json', name)
+        if match:
+            versions.append(int(match.group(1)))
+    return sorted(versions)
+
+
+def write_atomic(path, payload):
+    """
+    Пишет файл во временный рядом и подменяет его через os.replace:
+    читатели видят либо старую, либо новую версию целиком.
+    """
+    directory = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-', suffix='.json')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, path)
+    except BaseException:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def publish(products):
+    """
+    Публикует новую версию каталога: присваивает следующий номер версии,
+    сохраняет снимок в catalog_snapshots и атомарно подменяет products.json.
+    Блокирующая функция — из event loop вызывать через asyncio.to_thread.
+    Возвращает номер опубликованной версии.
+    """
+    os.makedirs(SNAPSHOTS_DIR, exist_ok=True)
+    versions = list_versions()
+    version = max([products.get('version', 0), *versions]) + 1
+    products['version'] = version
+    payload = json.dumps(products, ensure_ascii=False, indent=4)
+
+    write_atomic(_snapshot_path(version), payload)
+    write_atomic(PRODUCTS_JSON_PATH, payload)
+
+    # Удаляем самые старые снимки
+    for old_version in [*versions, version][:-SNAPSHOTS_TO_KEEP]:
+        try:
+            os.remove(_snapshot_path(old_version))
+        except OSError as e:
+            logger.warning(f"Не вдалося видалити знімок каталогу v{old_version}: {e}")
+    return version
+
+
+def load_version(version=None):
+    """
+    Загружает сохранённый снимок каталога (по умолчанию — последний).
+    Возвращает dict или None, если снимков нет.
+    """
+    versions = list_versions()
+    if version is None:
+        if not versions:
+            return None
+        version = versions[-1]
+    elif version not in versions:
+        return None
+    with open(_snapshot_path(version), 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+
+def rollback(version=None):
+    """
+    Откатывает products.json к сохранённому снимку
+    (по умолчанию — к предпоследней версии). Возвращает номер восстановленной версии.
+    Таблицы каталога в БД догонят файл при следующей синхронизации:
+    их версия будет отличаться от версии файла.
+    """
+    versions = list_versions()
+    if version is None:
+        if len(versions) < 2:
+            raise ValueError("Немає попередньої версії каталогу для відкату.")
+        version = versions[-2]
+    products = load_version(version)
+    if products is None:
+        raise ValueError(f"Знімок каталогу v{version} не знайдено.")
+    write_atomic(PRODUCTS_JSON_PATH, json.dumps(products, ensure_ascii=False, indent=4))
+    logger.info(f"Каталог відкочено до версії v{version}.")
+    return version
@@ -1,74 +1,454 @@
 # app/database.py
 
+import asyncio
 import aiosqlite
 import os
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+
+from app.catalog import CATEGORIES
+from app.options import OPTION_KEYS, options_to_mask, mask_to_options
+from app.order_status import OrderStatus, STATUS_TEXT, FINISHED_STATUSES, status_code, status_text
 
 DATABASE_PATH = 'app/database.db'
 
+# Размер пула долгоживущих соединений для чтения
+POOL_SIZE = 4
+# Сколько операций записи писатель объединяет в одну транзакцию
+WRITE_BATCH_SIZE = 32
+
+# Настройки соединения: WAL уже включён в init_db, он хранится в самом файле БД
+CONNECTION_PRAGMAS = (
+    "PRAGMA synchronous = NORMAL",
+    "PRAGMA cache_size = -16000",
+    "PRAGMA mmap_size = 67108864",
+    "PRAGMA busy_timeout = 5000",
+    "PRAGMA temp_store = MEMORY",
+)
+
+_pool = None
+_write_queue = None
+_writer_task = None
+
+
+async def _connect():
+    """
+    Открывает соединение с настроенными PRAGMA.
+    """
+    conn = await aiosqlite.connect(DATABASE_PATH)
+    for pragma in CONNECTION_PRAGMAS:
+        await conn.execute(pragma)
+    return conn
+
+
+async def open_pool():
+    """
+    Открывает пул постоянных соединений. Вызывается из init_db.
+    """
+    global _pool, _write_queue, _writer_task
+    if _pool is not None:
+        return
+    pool = asyncio.Queue()
+    for _ in range(POOL_SIZE):
+        pool.put_nowait(await _connect())
+    _pool = pool
+    _write_queue = asyncio.Queue()
+    _writer_task = asyncio.create_task(_writer(await _connect(), _write_queue))
+
+
+async def close_db():
+    """
+    Закрывает все соединения пула. Вызывается при остановке бота.
+    """
+    global _pool, _write_queue, _writer_task
+    pool, _pool = _pool, None
+    if pool is None:
+        return
+    # Писатель дорабатывает очередь и закрывает своё соединение
+    _write_queue.put_nowait(None)
+    await _writer_task
+    _write_queue = _writer_task = None
+    for _ in range(POOL_SIZE):
+        conn = await pool.get()
+        await conn.close()
+
+
+async def _writer(conn, queue):
+    """
+    Единственный писатель: выполняет все изменения через одно соединение.
+    Накопившиеся операции объединяются в одну транзакцию, каждая — в своём
+    SAVEPOINT, так что ошибка одной не откатывает остальные.
+    """
+    stopping = False
+    while not stopping:
+        jobs = [await queue.get()]
+        while len(jobs) < WRITE_BATCH_SIZE and not queue.empty():
+            jobs.append(queue.get_nowait())
+        if None in jobs:
+            stopping = True
+            jobs = [job for job in jobs if job is not None]
+        if not jobs:
+            continue
+
+        results = []
+        try:
+            await conn.execute("BEGIN")
+            for operation, future in jobs:
+                await conn.execute("SAVEPOINT write_job")
+                try:
+                    result = await operation(conn)
+                except Exception as e:
+                    await conn.execute("ROLLBACK TO write_job")
+                    await conn.execute("RELEASE write_job")
+                    results.append((future, None, e))
+                else:
+                    await conn.execute("RELEASE write_job")
+                    results.append((future, result, None))
+            await conn.commit()
+        except Exception as e:
+            if conn.in_transaction:
+                await conn.rollback()
+            results = [(future, None, e) for _, future in jobs]
+
+        # Результаты отдаём только после коммита
+        for future, result, error in results:
+            if future.cancelled():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+    await conn.close()
+
+
+async def _write(operation):
+    """
+    Выполняет операцию записи operation(db) через писателя и ждёт коммита.
+    Если писатель не запущен (скрипты, тесты), выполняет её на разовом соединении.
+    """
+    if _write_queue is None:
+        async with _connection() as db:
+            result = await operation(db)
+            await db.commit()
+            return result
+    future = asyncio.get_running_loop().create_future()
+    _write_queue.put_nowait((operation, future))
+    return await future
+
+
+@asynccontextmanager
+async def _connection():
+    """
+    Берёт соединение из пула на время запроса.
+    Если пул не открыт (скрипты, тесты), открывает разовое соединение.
+    """
+    if _pool is None:
+        conn = await _connect()
+        try:
+            yield conn
+        finally:
+            await conn.close()
+        return
+    conn = await _pool.get()
+    try:
+        yield conn
+    finally:
+        # Незавершённая транзакция не должна достаться следующему запросу
+        if conn.in_transaction:
+            await conn.rollback()
+        _pool.put_nowait(conn)
+
+
+# Условие «заказ ещё в работе»: одно и то же в частичном индексе и в запросах,
+# иначе SQLite не сможет использовать индекс
+_NOT_DELIVERED = f"status NOT IN ({', '.join(str(int(status)) for status in FINISHED_STATUSES)})"
+# Активные заказы с TTN, которые отслеживаются в Новой Почте
+_TRACKED = f"ttn IS NOT NULL AND {_NOT_DELIVERED}"
+# Маска опций из старых булевых колонок (бит = позиция в OPTION_KEYS)
+_OPTIONS_MASK_SQL = ' | '.join(f"((COALESCE({key}, 0) != 0) << {bit})" for bit, key in enumerate(OPTION_KEYS))
+_STATUS_CODE_SQL = (
+    "CASE status "
+    + ' '.join(f"WHEN '{text}' THEN {int(status)}" for status, text in STATUS_TEXT.items())
+    + f" ELSE {int(OrderStatus.NEW)} END"
+)
+
+# Миграции схемы: (версия, список SQL-запросов). Применённые версии
+# записываются в schema_version, новые добавляются только в конец списка.
+MIGRATIONS = [
+    (1, [
+        """
+        CREATE TABLE IF NOT EXISTS orders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            product TEXT NOT NULL,
+            size TEXT,
+            back_print BOOLEAN DEFAULT FALSE,
+            back_text BOOLEAN DEFAULT FALSE,
+            made_in_ukraine BOOLEAN DEFAULT FALSE,
+            collar BOOLEAN DEFAULT FALSE,
+            sleeve_text BOOLEAN DEFAULT FALSE,
+            city TEXT,
+            branch TEXT,
+            name TEXT,
+            phone TEXT,
+            payment_method TEXT,
+            status TEXT DEFAULT 'Нове',
+            price INTEGER,
+            ttn TEXT,
+            receipt_photo_id TEXT,
+            rejection_reason TEXT,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            selected_color_index INTEGER DEFAULT 0,
+            admin_message_id INTEGER  -- message_id сообщения администратору
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS discounts (
+            user_id INTEGER PRIMARY KEY,
+            ubd BOOLEAN DEFAULT FALSE,
+            repost BOOLEAN DEFAULT FALSE,
+            one_time_discount_used BOOLEAN DEFAULT FALSE,
+            rejection_reason_ubd TEXT,
+            rejection_reason_repost TEXT,
+            admin_message_id_ubd INTEGER,
+            admin_message_id_repost INTEGER
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS support_issues (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            issue_text TEXT NOT NULL,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS products (
+            model_id TEXT PRIMARY KEY,
+            category TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            model_name TEXT,
+            color_count INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_products_category_position ON products (category, position)",
+        """
+        CREATE TABLE IF NOT EXISTS product_colors (
+            model_id TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            media_id TEXT,
+            media_url TEXT NOT NULL,
+            PRIMARY KEY (model_id, position)
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS fsm_storage (
+            storage_key TEXT PRIMARY KEY,
+            state TEXT,
+            data TEXT NOT NULL DEFAULT '{}'
+        )
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS photo_file_ids (
+            image_key TEXT PRIMARY KEY,
+            file_id TEXT NOT NULL
+        )
+        """,
+    ]),
+    (2, [
+        "CREATE INDEX IF NOT EXISTS idx_orders_user_id ON orders (user_id)",
+        "CREATE INDEX IF NOT EXISTS idx_orders_status ON orders (status)",
+        "CREATE INDEX IF NOT EXISTS idx_orders_ttn ON orders (ttn)",
+        # Частичный индекс только по активным заказам; условие должно совпадать
+        # с WHERE в get_orders_not_delivered, иначе SQLite его не использует
+        """
+        CREATE INDEX IF NOT EXISTS idx_orders_active ON orders (id)
+        WHERE status != 'Доставлено' AND status != 'Відхилено'
+        """,
+    ]),
+    # Статус — число OrderStatus (текст в order_statuses), опции — битовая маска
+    (3, [
+        """
+        CREATE TABLE order_statuses (
+            code INTEGER PRIMARY KEY,
+            text TEXT NOT NULL
+        )
+        """,
+        "INSERT INTO order_statuses (code, text) VALUES "
+        + ', '.join(f"({int(status)}, '{text}')" for status, text in STATUS_TEXT.items()),
+        """
+        CREATE TABLE orders_new (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER NOT NULL,
+            product TEXT NOT NULL,
+            size TEXT,
+            options INTEGER NOT NULL DEFAULT 0,
+            city TEXT,
+            branch TEXT,
+            name TEXT,
+            phone TEXT,
+            payment_method TEXT,
+            status INTEGER NOT NULL DEFAULT 0 REFERENCES order_statuses (code),
+            price INTEGER,
+            ttn TEXT,
+            receipt_photo_id TEXT,
+            rejection_reason TEXT,
+            timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+            selected_color_index INTEGER DEFAULT 0,
+            admin_message_id INTEGER
+        )
+        """,
+        f"""
+        INSERT INTO orders_new (
+            id, user_id, product, size, options, city, branch, name, phone, payment_method,
+            status, price, ttn, receipt_photo_id, rejection_reason, timestamp,
+            selected_color_index, admin_message_id
+        )
+        SELECT
+            id, user_id, product, size, {_OPTIONS_MASK_SQL}, city, branch, name, phone, payment_method,
+            {_STATUS_CODE_SQL}, price, ttn, receipt_photo_id, rejection_reason, timestamp,
+            selected_color_index, admin_message_id
+        FROM orders
+        """,
+        "DROP TABLE orders",
+        "ALTER TABLE orders_new RENAME TO orders",
+        "CREATE INDEX idx_orders_user_id ON orders (user_id)",
+        "CREATE INDEX idx_orders_status ON orders (status)",
+        "CREATE INDEX idx_orders_ttn ON orders (ttn)",
+        f"CREATE INDEX idx_orders_active ON orders (id) WHERE {_NOT_DELIVERED}",
+    ]),
+    # Архив завершённых заказов; finished_at — когда заказ стал доставленным/отклонённым
+    (4, [
+        "ALTER TABLE orders ADD COLUMN finished_at DATETIME",
+        # Для уже завершённых заказов точное время неизвестно — берём время создания
+        f"UPDATE orders SET finished_at = timestamp WHERE NOT ({_NOT_DELIVERED})",
+        "CREATE INDEX idx_orders_finished_at ON orders (finished_at) WHERE finished_at IS NOT NULL",
+        """
+        CREATE TABLE orders_archive (
+            id INTEGER PRIMARY KEY,
+            user_id INTEGER NOT NULL,
+            product TEXT NOT NULL,
+            size TEXT,
+            options INTEGER NOT NULL DEFAULT 0,
+            city TEXT,
+            branch TEXT,
+            name TEXT,
+            phone TEXT,
+            payment_method TEXT,
+            status INTEGER NOT NULL,
+            price INTEGER,
+            ttn TEXT,
+            receipt_photo_id TEXT,
+            rejection_reason TEXT,
+            timestamp DATETIME,
+            selected_color_index INTEGER DEFAULT 0,
+            admin_message_id INTEGER,
+            finished_at DATETIME
+        )
+        """,
+        "CREATE INDEX idx_orders_archive_user_id ON orders_archive (user_id)",
+        "CREATE INDEX idx_orders_archive_status ON orders_archive (status)",
+    ]),
+    # Последний известный статус Новой Почты: трекинг после перезапуска продолжает с него
+    (5, [
+        "ALTER TABLE orders ADD COLUMN np_status_code TEXT",
+        "ALTER TABLE orders ADD COLUMN np_status_text TEXT",
+        "ALTER TABLE orders ADD COLUMN np_checked_at DATETIME",
+        "ALTER TABLE orders_archive ADD COLUMN np_status_code TEXT",
+        "ALTER TABLE orders_archive ADD COLUMN np_status_text TEXT",
+        "ALTER TABLE orders_archive ADD COLUMN np_checked_at DATETIME",
+        "UPDATE orders SET ttn = NULL WHERE ttn = ''",
+        f"CREATE INDEX idx_orders_tracked ON orders (id) WHERE {_TRACKED}",
+    ]),
+    # Цвет заказа по media id: позиции цветов сдвигаются, когда из поста удаляют фото
+    (6, [
+        "ALTER TABLE orders ADD COLUMN selected_color_media_id TEXT",
+        "ALTER TABLE orders_archive ADD COLUMN selected_color_media_id TEXT",
+        """
+        UPDATE orders SET selected_color_media_id = (
+            SELECT media_id FROM product_colors
+            WHERE model_id = orders.product AND position = orders.selected_color_index
+        )
+        """,
+        """
+        UPDATE orders_archive SET selected_color_media_id = (
+            SELECT media_id FROM product_colors
+            WHERE model_id = orders_archive.product AND position = orders_archive.selected_color_index
+        )
+        """,
+    ]),
+    # Версия products.json, с которой синхронизированы таблицы каталога
+    (7, [
+        """
+        CREATE TABLE catalog_version (
+            id INTEGER PRIMARY KEY CHECK (id = 1),
+            version INTEGER NOT NULL
+        )
+        """,
+    ]),
+]
+
+
+async def migrate(db):
+    """
+    Применяет недостающие миграции. Каждая миграция выполняется в своей транзакции
+    вместе с записью её номера в schema_version.
+    """
+    await db.execute("""
+        CREATE TABLE IF NOT EXISTS schema_version (
+            version INTEGER PRIMARY KEY,
+            applied_at DATETIME DEFAULT CURRENT_TIMESTAMP
+        )
+    """)
+    await db.commit()
+    cursor = await db.execute("SELECT COALESCE(MAX(version), 0) FROM schema_version")
+    current = (await cursor.fetchone())[0]
+    for version, statements in MIGRATIONS:
+        if version <= current:
+            continue
+        await db.execute("BEGIN")
+        try:
+            for statement in statements:
+                await db.execute(statement)
+            await db.execute("INSERT INTO schema_version (version) VALUES (?)", (version,))
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
+
 
 async def init_db():
     """
-    Инициализация базы данных. Создание необходимых таблиц.
+    Инициализация базы данных: включение WAL и применение миграций.
     """
     async with aiosqlite.connect(DATABASE_PATH) as db:
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS orders (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                product TEXT NOT NULL,
-                size TEXT,
-                back_print BOOLEAN DEFAULT FALSE,
-                back_text BOOLEAN DEFAULT FALSE,
-                made_in_ukraine BOOLEAN DEFAULT FALSE,
-                collar BOOLEAN DEFAULT FALSE,
-                sleeve_text BOOLEAN DEFAULT FALSE,
-                city TEXT,
-                branch TEXT,
-                name TEXT,
-                phone TEXT,
-                payment_method TEXT,
-                status TEXT DEFAULT 'Нове',
-                price INTEGER,
-                ttn TEXT,
-                receipt_photo_id TEXT,
-                rejection_reason TEXT,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
-                selected_color_index INTEGER DEFAULT 0,
-                admin_message_id INTEGER  -- Новое поле для хранения message_id администратора
-            )
-        """)
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS discounts (
-                user_id INTEGER PRIMARY KEY,
-                ubd BOOLEAN DEFAULT FALSE,
-                repost BOOLEAN DEFAULT FALSE,
-                one_time_discount_used BOOLEAN DEFAULT FALSE,
-                rejection_reason_ubd TEXT,
-                rejection_reason_repost TEXT,
-                admin_message_id_ubd INTEGER,
-                admin_message_id_repost INTEGER
-            )
-        """)
-        await db.execute("""
-            CREATE TABLE IF NOT EXISTS support_issues (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER NOT NULL,
-                issue_text TEXT NOT NULL,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
-            )
-        """)
-        await db.commit()
+        # WAL: читатели не блокируют писателя и друг друга
+        await db.execute("PRAGMA journal_mode = WAL")
+        await migrate(db)
+    await open_pool()
 
 
 # Остальной код остается без изменений
 
 # Ниже приведены все функции, которые уже были реализованы в вашем коде
 
-async def get_user_discounts(user_id):
-    """
-    Получение скидок пользователя.
-    """
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+# Кэш скидок: user_id -> (момент устаревания, {'ubd', 'repost'}), в порядке использования
+DISCOUNT_CACHE_TTL = 300
+DISCOUNT_CACHE_SIZE = 5000
+_discount_cache = OrderedDict()
+# Растёт при каждой инвалидации: чтение, начатое до изменения, не попадёт в кэш
+_discount_epoch = 0
+
+
+def _invalidate_discounts(user_id):
+    global _discount_epoch
+    _discount_epoch += 1
+    _discount_cache.pop(user_id, None)
+
+
+async def _load_user_discounts(user_id):
+    async with _connection() as db:
         cursor = await db.execute("SELECT ubd, repost FROM discounts WHERE user_id = ?", (user_id,))
         row = await cursor.fetchone()
         if row:
@@ -76,58 +456,93 @@ async def get_user_discounts(user_id):
                 'ubd': bool(row[0]),
                 'repost': bool(row[1])
             }
-        else:
-            # Если пользователь не имеет скидок, создаём запись
-            await db.execute("INSERT INTO discounts (user_id) VALUES (?)", (user_id,))
-            await db.commit()
-            return {
-                'ubd': False,
-                'repost': False
-            }
+    # Записи нет — скидок нет; строка появится при первой записи скидки
+    return {
+        'ubd': False,
+        'repost': False
+    }
+
+
+async def get_user_discounts(user_id):
+    """
+    Получение скидок пользователя. Результат кэшируется в памяти на
+    DISCOUNT_CACHE_TTL секунд и сбрасывается при изменении скидок.
+    """
+    now = time.monotonic()
+    cached = _discount_cache.get(user_id)
+    if cached is not None:
+        if cached[0] > now:
+            _discount_cache.move_to_end(user_id)
+            return dict(cached[1])
+        del _discount_cache[user_id]
+    epoch = _discount_epoch
+    discounts = await _load_user_discounts(user_id)
+    if epoch == _discount_epoch:
+        _discount_cache[user_id] = (time.monotonic() + DISCOUNT_CACHE_TTL, discounts)
+        # Вытесняем самые давно использованные записи сверх лимита
+        while len(_discount_cache) > DISCOUNT_CACHE_SIZE:
+            _discount_cache.popitem(last=False)
+    return dict(discounts)
 
 
 async def add_discount(user_id, discount_type):
     """
     Добавление скидки пользователю.
     """
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async def write(db):
         if discount_type == 'ubd':
-            await db.execute("UPDATE discounts SET ubd = ? WHERE user_id = ?", (True, user_id))
+            await db.execute("""
+                INSERT INTO discounts (user_id, ubd) VALUES (?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET ubd = excluded.ubd
+            """, (user_id, True))
         elif discount_type == 'repost':
             # При добавлении репост скидки, отмечаем, что одноразовая скидка использована
-            await db.execute("UPDATE discounts SET repost = ?, one_time_discount_used = ? WHERE user_id = ?", (True, True, user_id))
-        await db.commit()
+            await db.execute("""
+                INSERT INTO discounts (user_id, repost, one_time_discount_used) VALUES (?, ?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET
+                    repost = excluded.repost,
+                    one_time_discount_used = excluded.one_time_discount_used
+            """, (user_id, True, True))
+    await _write(write)
+    _invalidate_discounts(user_id)
 
 
 async def remove_discount(user_id, discount_type):
     """
     Удаление скидки у пользователя.
     """
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async def write(db):
         if discount_type == 'ubd':
             await db.execute("UPDATE discounts SET ubd = ? WHERE user_id = ?", (False, user_id))
         elif discount_type == 'repost':
             await db.execute("UPDATE discounts SET repost = ? WHERE user_id = ?", (False, user_id))
-        await db.commit()
+    await _write(write)
+    _invalidate_discounts(user_id)
 
 
 async def save_discount_rejection_reason(user_id, discount_type, reason):
     """
     Сохранение причины отказа для скидки.
     """
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async def write(db):
         if discount_type == 'ubd':
-            await db.execute("UPDATE discounts SET rejection_reason_ubd = ? WHERE user_id = ?", (reason, user_id))
+            await db.execute("""
+                INSERT INTO discounts (user_id, rejection_reason_ubd) VALUES (?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET rejection_reason_ubd = excluded.rejection_reason_ubd
+            """, (user_id, reason))
         elif discount_type == 'repost':
-            await db.execute("UPDATE discounts SET rejection_reason_repost = ? WHERE user_id = ?", (reason, user_id))
-        await db.commit()
+            await db.execute("""
+                INSERT INTO discounts (user_id, rejection_reason_repost) VALUES (?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET rejection_reason_repost = excluded.rejection_reason_repost
+            """, (user_id, reason))
+    await _write(write)
 
 
 async def is_one_time_discount_used(user_id):
     """
     Проверка, использована ли одноразовая скидка за репост.
     """
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async with _connection() as db:
         cursor = await db.execute("SELECT one_time_discount_used FROM discounts WHERE user_id = ?", (user_id,))
         row = await cursor.fetchone()
         if row:
@@ -139,243 +554,354 @@ async def mark_one_time_discount_used(user_id):
     """
     Отмечает, что одноразовая скидка за репост была использована.
     """
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        await db.execute("UPDATE discounts SET one_time_discount_used = ? WHERE user_id = ?", (True, user_id))
-        await db.commit()
+    async def write(db):
+        await db.execute("""
+            INSERT INTO discounts (user_id, one_time_discount_used) VALUES (?, ?)
+            ON CONFLICT(user_id) DO UPDATE SET one_time_discount_used = excluded.one_time_discount_used
+        """, (user_id, True))
+    await _write(write)
+    _invalidate_discounts(user_id)
 
 
-async def save_order(user_id, data):
+# Явный список колонок заказа: порядок в SELECT больше не зависит от схемы таблицы
+ORDER_COLUMNS = (
+    'id', 'user_id', 'product', 'size', 'options',
+    'city', 'branch', 'name', 'phone', 'payment_method', 'status', 'price',
+    'ttn', 'receipt_photo_id', 'rejection_reason', 'timestamp',
+    'selected_color_index', 'admin_message_id', 'finished_at',
+    'np_status_code', 'np_status_text', 'np_checked_at', 'selected_color_media_id',
+)
+_ORDER_COLUMNS_SQL = ', '.join(ORDER_COLUMNS)
+# История: активные заказы вместе с архивом. SQLite переносит внешний WHERE
+# внутрь UNION ALL, так что индексы обеих таблиц используются
+_ORDERS_WITH_ARCHIVE = (
+    f"(SELECT {_ORDER_COLUMNS_SQL} FROM orders"
+    f" UNION ALL SELECT {_ORDER_COLUMNS_SQL} FROM orders_archive)"
+)
+
+# Через сколько дней завершённый заказ переносится в orders_archive
+ARCHIVE_AFTER_DAYS = 30
+# Сколько заказов переносить за одну транзакцию
+ARCHIVE_BATCH_SIZE = 200
+
+
+def _order_select(include_archive=False):
+    source = _ORDERS_WITH_ARCHIVE if include_archive else "orders"
+    return f"SELECT {_ORDER_COLUMNS_SQL} FROM {source}"
+
+# Сколько заказов читать за один запрос при потоковой выборке
+ORDER_CHUNK_SIZE = 100
+# Сколько заказов показывать администратору на одной странице
+ORDER_PAGE_SIZE = 5
+
+
+def _row_to_order(row):
     """
-    Сохранение нового заказа в базу данных.
+    Преобразует строку из SELECT по ORDER_COLUMNS в dict заказа:
+    маска опций раскрывается в булевы ключи, код статуса — в его текст.
     """
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        await db.execute("""
+    order = dict(zip(ORDER_COLUMNS, row))
+    order.update(mask_to_options(order.pop('options') or 0))
+    order['status'] = status_text(order['status'])
+    return order
+
+
+async def _fetch_orders(where, params=(), include_archive=False):
+    async with _connection() as db:
+        cursor = await db.execute(f"{_order_select(include_archive)} WHERE {where} ORDER BY id", params)
+        return [_row_to_order(row) for row in await cursor.fetchall()]
+
+
+async def _iter_orders(where, params=(), chunk_size=ORDER_CHUNK_SIZE, include_archive=False):
+    """
+    Потоково отдаёт заказы порциями по chunk_size. Между порциями соединение
+    возвращается в пул, следующая порция продолжает с последнего id.
+    """
+    last_id = 0
+    while True:
+        async with _connection() as db:
+            cursor = await db.execute(
+                f"{_order_select(include_archive)} WHERE ({where}) AND id > ? ORDER BY id LIMIT ?",
+                (*params, last_id, chunk_size)
+            )
+            rows = await cursor.fetchall()
+        for row in rows:
+            yield _row_to_order(row)
+        if len(rows) < chunk_size:
+            return
+        last_id = rows[-1][0]
+
+
+async def _fetch_orders_page(where, params=(), after_id=None, before_id=None, limit=ORDER_PAGE_SIZE,
+                             include_archive=False):
+    """
+    Keyset-пагинация: страница из limit заказов после after_id (вперёд)
+    или перед before_id (назад). Возвращает (orders, has_prev, has_next).
+    """
+    select = _order_select(include_archive)
+    source = _ORDERS_WITH_ARCHIVE if include_archive else "orders"
+    async with _connection() as db:
+        if before_id is not None:
+            cursor = await db.execute(
+                f"{select} WHERE ({where}) AND id < ? ORDER BY id DESC LIMIT ?",
+                (*params, before_id, limit + 1)
+            )
+            rows = await cursor.fetchall()
+            has_prev = len(rows) > limit
+            rows = rows[:limit][::-1]
+            has_next = True
+        else:
+            cursor = await db.execute(
+                f"{select} WHERE ({where}) AND id > ? ORDER BY id LIMIT ?",
+                (*params, after_id or 0, limit + 1)
+            )
+            rows = await cursor.fetchall()
+            has_next = len(rows) > limit
+            rows = rows[:limit]
+            has_prev = after_id is not None
+        if rows:
+            # Соседние страницы могли опустеть (заказ доставлен, отклонён) — проверяем
+            if has_prev:
+                cursor = await db.execute(
+                    f"SELECT EXISTS(SELECT 1 FROM {source} WHERE ({where}) AND id < ?)", (*params, rows[0][0])
+                )
+                has_prev = bool((await cursor.fetchone())[0])
+            if has_next and before_id is not None:
+                cursor = await db.execute(
+                    f"SELECT EXISTS(SELECT 1 FROM {source} WHERE ({where}) AND id > ?)", (*params, rows[-1][0])
+                )
+                has_next = bool((await cursor.fetchone())[0])
+        else:
+            has_prev = has_next = False
+    return [_row_to_order(row) for row in rows], has_prev, has_next
+
+
+
+async def create_order(user_id, data):
+    """
+    Создаёт заказ одной транзакцией и возвращает полную запись заказа
+    (INSERT ... RETURNING), без отдельного запроса на чтение.
+    """
+    async def write(db):
+        cursor = await db.execute(f"""
             INSERT INTO orders (
-                user_id, product, size, back_print, back_text, made_in_ukraine, collar, sleeve_text,
-                city, branch, name, phone, payment_method, status, price, selected_color_index
-            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                user_id, product, size, options,
+                city, branch, name, phone, payment_method, status, price,
+                selected_color_index, selected_color_media_id
+            ) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            RETURNING {_ORDER_COLUMNS_SQL}
         """, (
             user_id,
             data.get('product'),
             data.get('size'),
-            data.get('back_print', False),
-            data.get('back_text', False),
-            data.get('made_in_ukraine', False),
-            data.get('collar', False),
-            data.get('sleeve_text', False),
+            options_to_mask(data),
             data.get('city'),
             data.get('branch'),
             data.get('name'),
             data.get('phone'),
             data.get('payment_method'),
-            data.get('status', 'Нове'),
+            status_code(data.get('status', OrderStatus.NEW)),
             data.get('price'),  # Сохраняем цену
-            data.get('selected_color_index', 0)  # Сохраняем выбранный цвет
+            data.get('selected_color_index', 0),  # Сохраняем выбранный цвет
+            data.get('selected_color_media_id')  # и его media id — по нему цвет ищется после сдвига позиций
         ))
-        await db.commit()
-        cursor = await db.execute("SELECT last_insert_rowid()")
-        row = await cursor.fetchone()
-        return row[0]  # Возвращаем ID заказа
+        return await cursor.fetchone()
+    return _row_to_order(await _write(write))
 
 
-async def get_orders_by_user(user_id):
+async def save_order(user_id, data):
     """
-    Получение всех заказов пользователя.
+    Сохранение нового заказа в базу данных. Возвращает ID заказа.
     """
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        cursor = await db.execute("SELECT * FROM orders WHERE user_id = ?", (user_id,))
-        rows = await cursor.fetchall()
-        orders = []
-        for row in rows:
-            orders.append({
-                'id': row[0],
-                'user_id': row[1],
-                'product': row[2],
-                'size': row[3],
-                'back_print': bool(row[4]),
-                'back_text': bool(row[5]),
-                'made_in_ukraine': bool(row[6]),
-                'collar': bool(row[7]),
-                'sleeve_text': bool(row[8]),
-                'city': row[9],
-                'branch': row[10],
-                'name': row[11],
-                'phone': row[12],
-                'payment_method': row[13],
-                'status': row[14],
-                'price': row[15],
-                'ttn': row[16],  # Новое поле
-                'receipt_photo_id': row[17],  # Новое поле
-                'rejection_reason': row[18],  # Новое поле
-                'timestamp': row[19],
-                'selected_color_index': row[20],  # Новое поле
-                'admin_message_id': row[21]  # Новое поле
-            })
-        return orders
+    order = await create_order(user_id, data)
+    return order['id']
+
+
+async def get_orders_by_user(user_id, include_archive=False):
+    """
+    Получение всех заказов пользователя; include_archive=True — вместе с архивом.
+    """
+    return await _fetch_orders("user_id = ?", (user_id,), include_archive)
 
 
 async def get_order_by_id(order_id):
     """
-    Получение заказа по ID.
+    Получение заказа по ID. Если заказа нет среди активных, ищем в архиве;
+    у архивного заказа order['archived'] = True — изменять его нельзя.
     """
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        cursor = await db.execute("SELECT * FROM orders WHERE id = ?", (order_id,))
+    async with _connection() as db:
+        cursor = await db.execute(f"{_order_select()} WHERE id = ?", (order_id,))
         row = await cursor.fetchone()
-        if row:
-            return {
-                'id': row[0],
-                'user_id': row[1],
-                'product': row[2],
-                'size': row[3],
-                'back_print': bool(row[4]),
-                'back_text': bool(row[5]),
-                'made_in_ukraine': bool(row[6]),
-                'collar': bool(row[7]),
-                'sleeve_text': bool(row[8]),
-                'city': row[9],
-                'branch': row[10],
-                'name': row[11],
-                'phone': row[12],
-                'payment_method': row[13],
-                'status': row[14],
-                'price': row[15],
-                'ttn': row[16],
-                'receipt_photo_id': row[17],
-                'rejection_reason': row[18],
-                'timestamp': row[19],
-                'selected_color_index': row[20],
-                'admin_message_id': row[21]
-            }
-        return None
+        archived = False
+        if row is None:
+            cursor = await db.execute(f"SELECT {_ORDER_COLUMNS_SQL} FROM orders_archive WHERE id = ?", (order_id,))
+            row = await cursor.fetchone()
+            archived = True
+        if row is None:
+            return None
+        order = _row_to_order(row)
+        order['archived'] = archived
+        return order
 
 
 async def get_orders_not_delivered():
     """
     Получение всех заказов, которые еще не доставлены.
     """
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        cursor = await db.execute("SELECT * FROM orders WHERE status != 'Доставлено' AND status != 'Відхилено'")
-        rows = await cursor.fetchall()
-        orders = []
-        for row in rows:
-            orders.append({
-                'id': row[0],
-                'user_id': row[1],
-                'product': row[2],
-                'size': row[3],
-                'back_print': bool(row[4]),
-                'back_text': bool(row[5]),
-                'made_in_ukraine': bool(row[6]),
-                'collar': bool(row[7]),
-                'sleeve_text': bool(row[8]),
-                'city': row[9],
-                'branch': row[10],
-                'name': row[11],
-                'phone': row[12],
-                'payment_method': row[13],
-                'status': row[14],
-                'price': row[15],
-                'ttn': row[16],
-                'receipt_photo_id': row[17],
-                'rejection_reason': row[18],
-                'timestamp': row[19],
-                'selected_color_index': row[20],
-                'admin_message_id': row[21]
-            })
-        return orders
-
-
-async def get_orders_by_status(status):
-    """
-    Получение всех заказов по статусу.
+    return await _fetch_orders(_NOT_DELIVERED)
+
+
+async def get_orders_by_status(status, include_archive=False):
     """
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        cursor = await db.execute("SELECT * FROM orders WHERE status = ?", (status,))
-        rows = await cursor.fetchall()
-        orders = []
-        for row in rows:
-            orders.append({
-                'id': row[0],
-                'user_id': row[1],
-                'product': row[2],
-                'size': row[3],
-                'back_print': bool(row[4]),
-                'back_text': bool(row[5]),
-                'made_in_ukraine': bool(row[6]),
-                'collar': bool(row[7]),
-                'sleeve_text': bool(row[8]),
-                'city': row[9],
-                'branch': row[10],
-                'name': row[11],
-                'phone': row[12],
-                'payment_method': row[13],
-                'status': row[14],
-                'price': row[15],
-                'ttn': row[16],
-                'receipt_photo_id': row[17],
-                'rejection_reason': row[18],
-                'timestamp': row[19],
-                'selected_color_index': row[20],
-                'admin_message_id': row[21]
-            })
-        return orders
+    Получение всех заказов по статусу; include_archive=True — вместе с архивом.
+    """
+    return await _fetch_orders("status = ?", (status_code(status),), include_archive)
+
+
+async def get_orders_not_delivered_page(after_id=None, before_id=None, limit=ORDER_PAGE_SIZE):
+    """
+    Страница недоставленных заказов, см. _fetch_orders_page.
+    """
+    return await _fetch_orders_page(_NOT_DELIVERED, (), after_id, before_id, limit)
+
+
+async def get_orders_by_status_page(status, after_id=None, before_id=None, limit=ORDER_PAGE_SIZE,
+                                    include_archive=False):
+    """
+    Страница заказов с заданным статусом, см. _fetch_orders_page.
+    """
+    return await _fetch_orders_page(
+        "status = ?", (status_code(status),), after_id, before_id, limit, include_archive
+    )
+
+
+def iter_orders_by_user(user_id, chunk_size=ORDER_CHUNK_SIZE, include_archive=False):
+    """
+    Потоковый вариант get_orders_by_user.
+    """
+    return _iter_orders("user_id = ?", (user_id,), chunk_size, include_archive)
+
+
+def iter_tracked_orders(chunk_size=ORDER_CHUNK_SIZE):
+    """
+    Потоково отдаёт активные заказы с TTN — те, что нужно отслеживать в Новой Почте.
+    """
+    return _iter_orders(_TRACKED, (), chunk_size)
 
 
 async def update_order_status(order_id, new_status):
     """
-    Обновление статуса заказа.
+    Обновление статуса заказа. new_status — OrderStatus или его текст.
     """
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        await db.execute("UPDATE orders SET status = ? WHERE id = ?", (new_status, order_id))
-        await db.commit()
+    new_status = status_code(new_status)
+    finished = new_status in FINISHED_STATUSES
+
+    async def write(db):
+        # finished_at нужен архиватору: отсчёт срока хранения в горячей таблице
+        await db.execute("""
+            UPDATE orders
+            SET status = ?, finished_at = CASE WHEN ? THEN COALESCE(finished_at, CURRENT_TIMESTAMP) END
+            WHERE id = ?
+        """, (new_status, finished, order_id))
+    await _write(write)
+
+
+async def archive_finished_orders(days=ARCHIVE_AFTER_DAYS, batch_size=ARCHIVE_BATCH_SIZE):
+    """
+    Переносит заказы, завершённые более days дней назад, из orders в orders_archive
+    порциями по batch_size (каждая — своя короткая транзакция писателя).
+    Возвращает количество перенесённых заказов.
+    """
+    selection = f"""
+        SELECT id FROM orders
+        WHERE finished_at IS NOT NULL AND finished_at < datetime('now', ?) AND NOT ({_NOT_DELIVERED})
+        ORDER BY id LIMIT ?
+    """
+    params = (f'-{int(days)} days', batch_size)
+
+    async def write(db):
+        await db.execute(f"""
+            INSERT INTO orders_archive ({_ORDER_COLUMNS_SQL})
+            SELECT {_ORDER_COLUMNS_SQL} FROM orders WHERE id IN ({selection})
+        """, params)
+        cursor = await db.execute(f"DELETE FROM orders WHERE id IN ({selection})", params)
+        return cursor.rowcount
+
+    total = 0
+    while True:
+        moved = await _write(write)
+        total += moved
+        if moved < batch_size:
+            return total
 
 
 async def update_order_ttn(order_id, ttn):
     """
-    Обновление номера ТТН заказа.
+    Обновление номера ТТН заказа. Сохранённый статус Новой Почты относился
+    к прежней ТТН, поэтому сбрасывается.
     """
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        await db.execute("UPDATE orders SET ttn = ? WHERE id = ?", (ttn, order_id))
-        await db.commit()
+    async def write(db):
+        await db.execute("""
+            UPDATE orders
+            SET ttn = ?, np_status_code = NULL, np_status_text = NULL, np_checked_at = NULL
+            WHERE id = ?
+        """, (ttn or None, order_id))
+    await _write(write)
+
+
+async def save_tracking_results(results):
+    """
+    Пакетно сохраняет результаты трекинга: results — список
+    (order_id, np_status_code, np_status_text); время проверки — текущее.
+    """
+    params = [(code, text, order_id) for order_id, code, text in results]
+    if not params:
+        return
+
+    async def write(db):
+        await db.executemany("""
+            UPDATE orders
+            SET np_status_code = ?, np_status_text = ?, np_checked_at = CURRENT_TIMESTAMP
+            WHERE id = ?
+        """, params)
+    await _write(write)
 
 
 async def save_order_receipt(order_id, receipt_photo_id):
     """
     Сохранение скриншота квитанции оплаты.
     """
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async def write(db):
         await db.execute("UPDATE orders SET receipt_photo_id = ? WHERE id = ?", (receipt_photo_id, order_id))
-        await db.commit()
+    await _write(write)
 
 
 async def save_order_rejection_reason(order_id, reason):
     """
     Сохранение причины отказа для заказа.
     """
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async def write(db):
         await db.execute("UPDATE orders SET rejection_reason = ? WHERE id = ?", (reason, order_id))
-        await db.commit()
+    await _write(write)
 
 
 async def save_user_issue(user_id, issue_text):
     """
     Сохранение обращения пользователя в поддержку.
     """
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        await db.execute("""
+    async def write(db):
+        cursor = await db.execute("""
             INSERT INTO support_issues (user_id, issue_text) VALUES (?, ?)
         """, (user_id, issue_text))
-        await db.commit()
-        cursor = await db.execute("SELECT last_insert_rowid()")
-        row = await cursor.fetchone()
-        return row[0]  # Возвращаем ID обращения
+        return cursor.lastrowid
+    return await _write(write)  # Возвращаем ID обращения
 
 
 async def get_user_issue(issue_id):
     """
     Получение обращения пользователя по ID.
     """
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async with _connection() as db:
         cursor = await db.execute("SELECT * FROM support_issues WHERE id = ?", (issue_id,))
         row = await cursor.fetchone()
         if row:
@@ -392,18 +918,230 @@ async def save_order_admin_message_id(order_id, message_id):
     """
     Сохранение message_id сообщения администратора для заказа.
     """
-    async with aiosqlite.connect(DATABASE_PATH) as db:
-        await db.execute("UPDATE orders SET admin_message_id = ? WHERE id = ?", (message_id, order_id))
-        await db.commit()
+    await save_order_admin_message_ids([(order_id, message_id)])
+
+
+async def save_order_admin_message_ids(pairs):
+    """
+    Пакетно сохраняет message_id администратора: pairs — список (order_id, message_id).
+    """
+    pairs = [(message_id, order_id) for order_id, message_id in pairs]
+    if not pairs:
+        return
+
+    async def write(db):
+        await db.executemany("UPDATE orders SET admin_message_id = ? WHERE id = ?", pairs)
+    await _write(write)
 
 
 async def save_discount_admin_message_id(user_id, discount_type, message_id):
     """
     Сохранение message_id сообщения администратора для скидки.!!
     """
-    async with aiosqlite.connect(DATABASE_PATH) as db:
+    async def write(db):
         if discount_type == 'ubd':
-            await db.execute("UPDATE discounts SET admin_message_id_ubd = ? WHERE user_id = ?", (message_id, user_id))
+            await db.execute("""
+                INSERT INTO discounts (user_id, admin_message_id_ubd) VALUES (?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET admin_message_id_ubd = excluded.admin_message_id_ubd
+            """, (user_id, message_id))
         elif discount_type == 'repost':
-            await db.execute("UPDATE discounts SET admin_message_id_repost = ? WHERE user_id = ?", (message_id, user_id))
-        await db.commit()
+            await db.execute("""
+                INSERT INTO discounts (user_id, admin_message_id_repost) VALUES (?, ?)
+                ON CONFLICT(user_id) DO UPDATE SET admin_message_id_repost = excluded.admin_message_id_repost
+            """, (user_id, message_id))
+    await _write(write)
+
+
+async def get_photo_file_ids():
+    """
+    Получение всех сохранённых Telegram file_id изображений каталога.
+    """
+    async with _connection() as db:
+        cursor = await db.execute("SELECT image_key, file_id FROM photo_file_ids")
+        rows = await cursor.fetchall()
+        return {row[0]: row[1] for row in rows}
+
+
+async def save_photo_file_id(image_key, file_id):
+    """
+    Сохранение Telegram file_id для изображения каталога.
+    """
+    async def write(db):
+        await db.execute("""
+            INSERT INTO photo_file_ids (image_key, file_id) VALUES (?, ?)
+            ON CONFLICT(image_key) DO UPDATE SET file_id = excluded.file_id
+        """, (image_key, file_id))
+    await _write(write)
+
+
+async def delete_photo_file_id(image_key):
+    """
+    Удаление недействительного file_id изображения.
+    """
+    async def write(db):
+        await db.execute("DELETE FROM photo_file_ids WHERE image_key = ?", (image_key,))
+    await _write(write)
+
+
+async def sync_catalog(products):
+    """
+    Синхронизация таблиц products / product_colors со структурой каталога
+    (формат products.json). Записываются только изменившиеся строки;
+    вместе с ними в той же транзакции сохраняется версия каталога.
+    Возвращает (изменено строк, удалено строк).
+    """
+    version = products.get('version', 0)
+    desired_products = {}
+    desired_colors = {}
+    for category in CATEGORIES:
+        for position, product in enumerate(products.get(category, [])):
+            colors = product.get('colors', [])
+            model_id = product['model_id']
+            desired_products[model_id] = (category, position, product.get('model_name'), len(colors))
+            for color_position, color in enumerate(colors):
+                if isinstance(color, dict):
+                    media_id, media_url = color.get('media_id'), color.get('media_url')
+                else:
+                    media_id, media_url = None, color
+                desired_colors[(model_id, color_position)] = (media_id, media_url)
+
+    # Сверка и запись выполняются в писателе, чтобы между ними не вклинилась другая запись
+    async def write(db):
+        cursor = await db.execute("SELECT model_id, category, position, model_name, color_count FROM products")
+        current_products = {row[0]: tuple(row[1:]) for row in await cursor.fetchall()}
+        cursor = await db.execute("SELECT model_id, position, media_id, media_url FROM product_colors")
+        current_colors = {(row[0], row[1]): (row[2], row[3]) for row in await cursor.fetchall()}
+
+        product_upserts = [
+            (model_id, *values) for model_id, values in desired_products.items()
+            if current_products.get(model_id) != values
+        ]
+        color_upserts = [
+            (*key, *values) for key, values in desired_colors.items()
+            if current_colors.get(key) != values
+        ]
+        product_deletes = [(model_id,) for model_id in current_products if model_id not in desired_products]
+        color_deletes = [key for key in current_colors if key not in desired_colors]
+
+        await db.executemany("""
+            INSERT INTO products (model_id, category, position, model_name, color_count) VALUES (?, ?, ?, ?, ?)
+            ON CONFLICT(model_id) DO UPDATE SET
+                category = excluded.category,
+                position = excluded.position,
+                model_name = excluded.model_name,
+                color_count = excluded.color_count
+        """, product_upserts)
+        await db.executemany("""
+            INSERT INTO product_colors (model_id, position, media_id, media_url) VALUES (?, ?, ?, ?)
+            ON CONFLICT(model_id, position) DO UPDATE SET
+                media_id = excluded.media_id,
+                media_url = excluded.media_url
+        """, color_upserts)
+        await db.executemany("DELETE FROM products WHERE model_id = ?", product_deletes)
+        await db.executemany("DELETE FROM product_colors WHERE model_id = ? AND position = ?", color_deletes)
+        await db.execute("""
+            INSERT INTO catalog_version (id, version) VALUES (1, ?)
+            ON CONFLICT(id) DO UPDATE SET version = excluded.version
+        """, (version,))
+        return len(product_upserts) + len(color_upserts), len(product_deletes) + len(color_deletes)
+    return await _write(write)
+
+
+async def get_catalog_version():
+    """
+    Версия каталога, с которой синхронизированы таблицы, или None, если синхронизации не было.
+    """
+    async with _connection() as db:
+        cursor = await db.execute("SELECT version FROM catalog_version WHERE id = 1")
+        row = await cursor.fetchone()
+        return row[0] if row else None
+
+
+async def get_catalog_product(category, position):
+    """
+    Получение модели категории по позиции. Позиция берётся по модулю
+    количества моделей, поэтому -1 означает последнюю модель.
+    Возвращает dict с полем total_products или None, если категория пуста.
+    """
+    async with _connection() as db:
+        cursor = await db.execute("""
+            WITH total AS (SELECT COUNT(*) AS n FROM products WHERE category = ?)
+            SELECT p.model_id, p.model_name, p.position, p.color_count, total.n
+            FROM products p, total
+            WHERE p.category = ? AND total.n > 0
+              AND p.position = ((? % total.n) + total.n) % total.n
+        """, (category, category, position))
+        row = await cursor.fetchone()
+        if row:
+            return {
+                'model_id': row[0],
+                'model_name': row[1],
+                'position': row[2],
+                'color_count': row[3],
+                'total_products': row[4]
+            }
+        return None
+
+
+async def get_product_color(model_id, position):
+    """
+    Получение цвета модели по позиции.
+    """
+    async with _connection() as db:
+        cursor = await db.execute(
+            "SELECT media_id, media_url FROM product_colors WHERE model_id = ? AND position = ?",
+            (model_id, position)
+        )
+        row = await cursor.fetchone()
+        if row:
+            return {
+                'media_id': row[0],
+                'media_url': row[1]
+            }
+        return None
+
+
+async def get_product_color_by_media_id(model_id, media_id):
+    """
+    Получение цвета модели по media id (позиция цвета могла сдвинуться).
+    """
+    async with _connection() as db:
+        cursor = await db.execute(
+            "SELECT media_id, media_url FROM product_colors WHERE model_id = ? AND media_id = ?",
+            (model_id, media_id)
+        )
+        row = await cursor.fetchone()
+        if row:
+            return {
+                'media_id': row[0],
+                'media_url': row[1]
+            }
+        return None
+
+
+async def get_fsm_record(storage_key):
+    """
+    Получение состояния и данных FSM по ключу. Возвращает (state, data_json) или None.
+    """
+    async with _connection() as db:
+        cursor = await db.execute("SELECT state, data FROM fsm_storage WHERE storage_key = ?", (storage_key,))
+        row = await cursor.fetchone()
+        if row:
+            return row[0], row[1]
+        return None
+
+
+async def save_fsm_records(records):
+    """
+    Пакетное сохранение записей FSM одной транзакцией.
+    records — список (storage_key, state, data_json); пустые записи удаляются.
+    """
+    upserts = [record for record in records if record[1] is not None or record[2] != '{}']
+    deletes = [(record[0],) for record in records if record[1] is None and record[2] == '{}']
+    async def write(db):
+        await db.executemany("""
+            INSERT INTO fsm_storage (storage_key, state, data) VALUES (?, ?, ?)
+            ON CONFLICT(storage_key) DO UPDATE SET state = excluded.state, data = excluded.data
+        """, upserts)
+        await db.executemany("DELETE FROM fsm_storage WHERE storage_key = ?", deletes)
+    await _write(write)
@@ -1,33 +1,31 @@
 # app/fetch_instagram.py
 
-import requests
+import asyncio
+import aiohttp
+import aiofiles
 import json
 import os
 from datetime import datetime
 import re
 import logging
 
+from app import catalog
+from app import database as db
+
 # Загрузка переменных окружения
 from dotenv import load_dotenv
 load_dotenv()
 
-# Настройка логирования
-logging.basicConfig(
-    level=logging.INFO,  # Уровень логирования
-    format='%(asctime)s - %(levelname)s - %(message)s',
-    handlers=[
-        logging.FileHandler("fetch_instagram.log"),  # Логирование в файл
-        logging.StreamHandler()  # Логирование в консоль
-    ]
-)
+# Логгер модуля; корневое логирование настраивает бот или запуск скрипта (см. __main__)
+logger = logging.getLogger(__name__)
 
 INSTAGRAM_BUSINESS_ACCOUNT_ID = os.environ.get("INSTAGRAM_BUSINESS_ACCOUNT_ID")
 ACCESS_TOKEN = os.environ.get("INSTAGRAM_ACCESS_TOKEN")
 
-# Проверка наличия необходимых переменных окружения
+# Проверка наличия необходимых переменных окружения.
+# Модуль импортируется ботом, поэтому вместо exit() синхронизация просто не запускается.
 if not INSTAGRAM_BUSINESS_ACCOUNT_ID or not ACCESS_TOKEN:
-    logging.error("Необходимо установить INSTAGRAM_BUSINESS_ACCOUNT_ID и ACCESS_TOKEN в .env файле.")
-    exit(1)
+    logger.error("Необходимо установить INSTAGRAM_BUSINESS_ACCOUNT_ID и ACCESS_TOKEN в .env файле.")
 
 # Определяем путь относительно текущего файла
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -37,67 +35,179 @@ PRODUCTS_JSON_PATH = os.path.join(BASE_DIR, 'products.json')
 HASHTAG_TS = '#ts'
 HASHTAG_HD = '#hd'
 
-def get_recent_media():
+SYNC_STATE_PATH = os.path.join(BASE_DIR, 'instagram_sync_state.json')
+
+# Ограничение на количество страниц за один проход
+MAX_MEDIA_PAGES = 50
+# Раз в сутки перечитываем всю ленту: обновляем подписанные ссылки и удалённые медиа
+FULL_SYNC_INTERVAL = 24 * 3600
+
+# Таймауты запросов к Graph API (сек)
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=60, connect=10)
+
+# Не даём двум синхронизациям работать одновременно
+_sync_lock = asyncio.Lock()
+
+
+def _empty_products():
+    return {
+        "t_shirts": [],
+        "hoodies": []
+    }
+
+
+def _parse_timestamp(value):
     """
-    Получает последние медиа из Instagram аккаунта.
+    Разбирает timestamp Graph API вида 2024-10-31T19:41:59+0000.
+    """
+    return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S%z')
+
+
+async def get_recent_media(session, high_water_mark=None):
+    """
+    Получает медиа из Instagram аккаунта, проходя по курсорам paging.next.
+    Без high_water_mark выгружает всю ленту (первичная загрузка), иначе
+    останавливается на первом посте, который уже был обработан.
+    Возвращает (список постов, признак того, что выборка полная).
     """
     url = f'https://graph.facebook.com/v21.0/{INSTAGRAM_BUSINESS_ACCOUNT_ID}/media'
     params = {
-        'fields': 'id,caption,media_type,media_url,permalink,timestamp,children{media_type,media_url}',
+        'fields': 'id,caption,media_type,media_url,permalink,timestamp,children{id,media_type,media_url}',
         'access_token': ACCESS_TOKEN,
         'limit': 100  # Максимальное количество медиа за один запрос
     }
+    hwm_id = hwm_time = None
+    if high_water_mark:
+        hwm_id = high_water_mark.get('last_id')
+        hwm_time = _parse_timestamp(high_water_mark['last_timestamp'])
+
+    media = []
+    pages = 0
     try:
-        response = requests.get(url, params=params)
-        response.raise_for_status()
-        data = response.json()
-        logging.info(f"Получено {len(data.get('data', []))} медиа-постов.")
-        return data.get('data', [])
-    except requests.exceptions.HTTPError as http_err:
-        logging.error(f"HTTP ошибка при получении медиа: {http_err}")
+        while url and pages < MAX_MEDIA_PAGES:
+            async with session.get(url, params=params) as response:
+                response.raise_for_status()
+                data = await response.json()
+            pages += 1
+            for post in data.get('data', []):
+                # Лента отдаётся от новых к старым: дальше идут уже обработанные посты
+                if hwm_time and (post.get('id') == hwm_id or _parse_timestamp(post['timestamp']) < hwm_time):
+                    logger.info(f"Получено {len(media)} новых медиа-постов ({pages} стор.).")
+                    return media, True
+                media.append(post)
+            # Ссылка next уже содержит все параметры запроса и курсор
+            url = data.get('paging', {}).get('next')
+            params = None
+        logger.info(f"Получено {len(media)} медиа-постов ({pages} стор.).")
+        return media, not url
+    except aiohttp.ClientResponseError as http_err:
+        logger.error(f"HTTP ошибка при получении медиа: {http_err.status} {http_err.message}")
     except Exception as err:
-        logging.error(f"Ошибка при получении медиа: {err}")
-    return []
+        logger.error(f"Ошибка при получении медиа: {err}")
+    return media, False
+
 
-def load_existing_products():
+async def load_sync_state():
+    """
+    Загружает состояние синхронизации (high-water mark и время полной выгрузки).
+    """
+    if not os.path.exists(SYNC_STATE_PATH):
+        return {}
+    try:
+        async with aiofiles.open(SYNC_STATE_PATH, 'r', encoding='utf-8') as f:
+            return json.loads(await f.read())
+    except Exception as e:
+        logger.error(f"Ошибка при загрузке состояния синхронизации: {e}")
+        return {}
+
+
+async def save_sync_state(state):
+    """
+    Сохраняет состояние синхронизации атомарно (временный файл + rename):
+    обрыв записи не повредит файл и не вызовет лишнюю полную выгрузку.
+    """
+    try:
+        payload = json.dumps(state, ensure_ascii=False, indent=4)
+        await asyncio.to_thread(catalog.write_atomic, SYNC_STATE_PATH, payload)
+    except Exception as e:
+        logger.error(f"Ошибка при сохранении состояния синхронизации: {e}")
+
+
+def _needs_full_sync(state):
+    last_full_sync = state.get('last_full_sync')
+    if not state.get('last_timestamp') or not last_full_sync:
+        return True
+    elapsed = datetime.now() - datetime.fromisoformat(last_full_sync)
+    return elapsed.total_seconds() >= FULL_SYNC_INTERVAL
+
+
+async def load_existing_products():
     """
     Загружает существующие продукты из JSON файла или инициализирует структуру.
+    Если файл повреждён, берётся последний сохранённый снимок каталога;
+    если и его нет — возвращается None, и синхронизация не перезаписывает каталог.
     """
     if not os.path.exists(PRODUCTS_JSON_PATH):
         # Инициализируем пустую структуру
-        logging.info("Файл products.json не найден. Инициализирую пустую структуру.")
-        return {
-            "t_shirts": [],
-            "hoodies": []
-        }
+        logger.info("Файл products.json не найден. Инициализирую пустую структуру.")
+        return _empty_products()
     try:
-        with open(PRODUCTS_JSON_PATH, 'r', encoding='utf-8') as f:
-            products = json.load(f)
-            logging.info(f"Загружено {len(products.get('t_shirts', []))} футболок и {len(products.get('hoodies', []))} худі из products.json.")
-            return products
+        async with aiofiles.open(PRODUCTS_JSON_PATH, 'r', encoding='utf-8') as f:
+            raw = await f.read()
+        # Разбор JSON выполняем вне event loop
+        products = await asyncio.to_thread(json.loads, raw)
+        logger.info(f"Загружено {len(products.get('t_shirts', []))} футболок и {len(products.get('hoodies', []))} худі из products.json.")
+        return products
     except json.JSONDecodeError:
-        logging.warning("Ошибка декодирования JSON. Инициализирую пустую структуру.")
-        return {
-            "t_shirts": [],
-            "hoodies": []
-        }
+        logger.warning("Ошибка декодирования JSON. Пробую загрузить последний снимок каталога.")
     except Exception as e:
-        logging.error(f"Ошибка при загрузке продуктов: {e}")
-        return {
-            "t_shirts": [],
-            "hoodies": []
-        }
+        logger.error(f"Ошибка при загрузке продуктов: {e}")
+
+    try:
+        products = await asyncio.to_thread(catalog.load_version)
+    except Exception as e:
+        logger.error(f"Ошибка при загрузке снимка каталога: {e}")
+        products = None
+    if products is not None:
+        logger.info(f"Загружен снимок каталога v{products.get('version')}.")
+    return products
+
 
-def save_products(products):
+async def ensure_catalog_synced(products=None):
+    """
+    Приводит таблицы каталога в БД к products.json (по умолчанию — читает файл).
+    Синхронизация выполняется, только если версия в БД отличается от версии
+    файла: прошлая запись в БД не удалась или каталог откатили (rollback).
+    """
+    if products is None:
+        if not os.path.exists(PRODUCTS_JSON_PATH):
+            return
+        products = await load_existing_products()
+        if products is None:
+            return
+    version = products.get('version', 0)
+    try:
+        if await db.get_catalog_version() == version:
+            return
+        changed, deleted = await db.sync_catalog(products)
+        logger.info(f"🗄️ Каталог у БД оновлено до v{version}: змінено {changed}, видалено {deleted} рядків.")
+    except Exception as e:
+        logger.error(f"Ошибка при обновлении каталога в БД: {e}")
+
+
+async def save_products(products):
     """
     Сохраняет обновлённые продукты в JSON файл.
+    Публикация атомарная (временный файл + rename) и выполняется вне event loop.
     """
     try:
-        with open(PRODUCTS_JSON_PATH, 'w', encoding='utf-8') as f:
-            json.dump(products, f, ensure_ascii=False, indent=4)
-        logging.info(f"✅ Продукты успешно сохранены в {PRODUCTS_JSON_PATH}.")
+        version = await asyncio.to_thread(catalog.publish, products)
+        logger.info(f"✅ Продукты успешно сохранены в {PRODUCTS_JSON_PATH} (версия {version}).")
+        return True
     except Exception as e:
-        logging.error(f"Ошибка при сохранении продуктов: {e}")
+        logger.error(f"Ошибка при сохранении продуктов: {e}")
+        return False
+
 
 def extract_hashtags(caption):
     """
@@ -108,17 +218,47 @@ def extract_hashtags(caption):
     hashtags = re.findall(r'#\w+', caption.lower())
     return hashtags
 
-def fetch_and_update_products():
+def color_media_id(color):
     """
-    Основная функция для получения и обновления продуктов.
+    Возвращает media id цвета. Старые записи products.json хранили только URL — у них id нет.
     """
-    logging.info("Начинаю обновление продуктовых данных.")
-    media = get_recent_media()
-    if not media:
-        logging.error("❌ Нет доступных медиа или произошла ошибка при получении данных.")
-        return
+    if isinstance(color, dict):
+        return color.get('media_id')
+    return None
 
-    products = load_existing_products()
+
+def merge_colors(existing_colors, images):
+    """
+    Сверяет цвета модели с актуальными медиа поста по media id.
+    URL существующих цветов обновляются на месте, цвета без медиа удаляются.
+    Возвращает (новый список цветов, добавлено, удалено, обновлено URL).
+    """
+    existing_by_id = {}
+    for color in existing_colors:
+        media_id = color_media_id(color)
+        if media_id:
+            existing_by_id[media_id] = color
+
+    merged = []
+    added = refreshed = 0
+    for image in images:
+        old = existing_by_id.get(image['media_id'])
+        if old is None:
+            added += 1
+        elif old.get('media_url') != image['media_url']:
+            refreshed += 1
+        merged.append(image)
+
+    current_ids = {image['media_id'] for image in images}
+    removed = sum(1 for color in existing_colors if color_media_id(color) not in current_ids)
+    return merged, added, removed, refreshed
+
+
+def apply_media(products, media):
+    """
+    Применяет полученные посты к структуре продуктов.
+    Возвращает количество добавленных моделей.
+    """
     t_shirts = products.get('t_shirts', [])
     hoodies = products.get('hoodies', [])
 
@@ -131,35 +271,36 @@ def fetch_and_update_products():
     for post in media:
         caption = post.get('caption', '').lower()
         hashtags = extract_hashtags(caption)
-        logging.info(f"📄 Обрабатывается пост ID: {post.get('id')}, хэштеги: {hashtags}")
+        logger.info(f"📄 Обрабатывается пост ID: {post.get('id')}, хэштеги: {hashtags}")
 
         is_ts = HASHTAG_TS in hashtags
         is_hd = HASHTAG_HD in hashtags
 
         if not (is_ts or is_hd):
-            logging.info("❌ Пропускаем пост без нужных хэштегов.")
+            logger.info("❌ Пропускаем пост без нужных хэштегов.")
             continue
 
         product_type = 't_shirts' if is_ts else 'hoodies'
-        logging.info(f"📦 Обнаружена категория: {product_type}")
+        logger.info(f"📦 Обнаружена категория: {product_type}")
 
         # Извлекаем ссылки на изображения
         media_type = post.get('media_type')
         images = []
 
+        # Цвет идентифицируется id медиа: подписанные ссылки CDN меняются при каждом запросе
         if media_type == 'IMAGE':
-            images.append(post.get('media_url'))
+            images.append({'media_id': post.get('id'), 'media_url': post.get('media_url')})
         elif media_type == 'CAROUSEL_ALBUM':
             children = post.get('children', {}).get('data', [])
             for child in children:
                 if child.get('media_type') == 'IMAGE':
-                    images.append(child.get('media_url'))
+                    images.append({'media_id': child.get('id'), 'media_url': child.get('media_url')})
         else:
-            logging.warning(f"⚠️ Пропускаем пост с типом медиа: {media_type}")
+            logger.warning(f"⚠️ Пропускаем пост с типом медиа: {media_type}")
             continue
 
         if not images:
-            logging.warning(f"⚠️ Пост {post.get('id')} не содержит изображений.")
+            logger.warning(f"⚠️ Пост {post.get('id')} не содержит изображений.")
             continue
 
         # Генерируем model_id и model_name
@@ -170,16 +311,14 @@ def fetch_and_update_products():
         existing_products = existing_ts_ids if product_type == 't_shirts' else existing_hd_ids
 
         if model_id in existing_products:
-            # Обновляем список цветов для существующей модели
+            # Сверяем цвета существующей модели по media id
             existing_product = existing_products[model_id]
-            # Добавляем новые изображения, избегая дубликатов
-            existing_images = set(existing_product.get('colors', []))
-            new_images = [img for img in images if img not in existing_images]
-            if new_images:
-                existing_product['colors'].extend(new_images)
-                logging.info(f"🔄 Обновлена модель {model_name}: добавлено {len(new_images)} новых цветов.")
+            colors, added, removed, refreshed = merge_colors(existing_product.get('colors', []), images)
+            existing_product['colors'] = colors
+            if added or removed:
+                logger.info(f"🔄 Обновлена модель {model_name}: добавлено {added}, видалено {removed} кольорів.")
             else:
-                logging.info(f"🔄 Модель {model_name} уже содержит все изображения. Пропускаем.")
+                logger.info(f"🔄 Модель {model_name} уже содержит все изображения (оновлено посилань: {refreshed}).")
             continue
         else:
             # Добавляем новую модель
@@ -196,16 +335,96 @@ def fetch_and_update_products():
                 existing_hd_ids[model_id] = new_model
 
             new_products_count += 1
-            logging.info(f"✅ Добавлена новая {product_type[:-1].capitalize()}: {model_name} с {len(images)} цветами.")
+            logger.info(f"✅ Добавлена новая {product_type[:-1].capitalize()}: {model_name} с {len(images)} цветами.")
 
     # Обновляем структуру продуктов
     products['t_shirts'] = t_shirts
     products['hoodies'] = hoodies
+    return new_products_count
+
+
+def prune_deleted_models(products, media):
+    """
+    Удаляет модели, посты которых не вернулись в полной выборке ленты (пост удалён).
+    Вызывать только с полной выборкой, иначе пропадут модели из недочитанных страниц.
+    Возвращает количество удалённых моделей.
+    """
+    post_ids = {post.get('id') for post in media}
+    removed = 0
+    for category in catalog.CATEGORIES:
+        kept = []
+        for item in products.get(category, []):
+            # model_id = префикс категории ('ts' / 'hd') + id поста
+            if item['model_id'][2:] in post_ids:
+                kept.append(item)
+            else:
+                removed += 1
+                logger.info(f"🗑️ Пост моделі {item.get('model_name')} видалено — прибираю її з каталогу.")
+        products[category] = kept
+    return removed
+
+
+async def fetch_and_update_products():
+    """
+    Основная функция для получения и обновления продуктов.
+    Не блокирует event loop: сеть через aiohttp, JSON — в отдельном потоке,
+    атомарная публикация файла — тоже в потоке. Можно планировать из цикла бота.
+    """
+    async with _sync_lock:
+        # БД догоняет products.json на каждом проходе, даже если новых постов нет
+        await ensure_catalog_synced()
+
+        if not INSTAGRAM_BUSINESS_ACCOUNT_ID or not ACCESS_TOKEN:
+            logger.error("❌ Синхронизация пропущена: не заданы INSTAGRAM_BUSINESS_ACCOUNT_ID / INSTAGRAM_ACCESS_TOKEN.")
+            return
+
+        state = await load_sync_state()
+        full_sync = _needs_full_sync(state)
+        logger.info(f"Начинаю {'полное' if full_sync else 'инкрементальное'} обновление продуктовых данных.")
+        async with aiohttp.ClientSession(timeout=REQUEST_TIMEOUT) as session:
+            media, complete = await get_recent_media(session, None if full_sync else state)
+        if not media:
+            if complete:
+                logger.info("Новых медиа нет, каталог не изменился.")
+            else:
+                logger.error("❌ Нет доступных медиа или произошла ошибка при получении данных.")
+            return
+
+        products = await load_existing_products()
+        if products is None:
+            logger.error("❌ Каталог повреждён и снимков нет — синхронизацию прервано, чтобы не затереть товары.")
+            return
+        new_products_count = await asyncio.to_thread(apply_media, products, media)
+        if full_sync and complete:
+            await asyncio.to_thread(prune_deleted_models, products, media)
+
+        # Сохраняем обратно в JSON файл
+        if not await save_products(products):
+            return
+        # Переносим в SQLite только изменившиеся строки каталога; если запись
+        # не удастся, версии разойдутся и следующий проход повторит синхронизацию
+        await ensure_catalog_synced(products)
 
-    # Сохраняем обратно в JSON файл
-    save_products(products)
+        # Сдвигаем high-water mark только после полной выборки,
+        # иначе пропущенные посты не попадут в следующий инкремент
+        if complete:
+            newest = media[0]
+            state['last_id'] = newest.get('id')
+            state['last_timestamp'] = newest.get('timestamp')
+            if full_sync:
+                state['last_full_sync'] = datetime.now().isoformat()
+            await save_sync_state(state)
 
-    logging.info(f"📦 Обновление продуктовых данных завершено. Добавлено {new_products_count} новых продуктов.")
+        logger.info(f"📦 Обновление продуктовых данных завершено. Добавлено {new_products_count} новых продуктов.")
 
 if __name__ == '__main__':
-    fetch_and_update_products()
+    # Настройка логирования при запуске скрипта отдельно от бота
+    logging.basicConfig(
+        level=logging.INFO,  # Уровень логирования
+        format='%(asctime)s - %(levelname)s - %(message)s',
+        handlers=[
+            logging.FileHandler("fetch_instagram.log"),  # Логирование в файл
+            logging.StreamHandler()  # Логирование в консоль
+        ]
+    )
+    asyncio.run(fetch_and_update_products())
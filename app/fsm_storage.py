@@ -0,0 +1,151 @@
+# app/fsm_storage.py
+
+import asyncio
+import json
+import logging
+from collections import OrderedDict
+
+from aiogram import BaseMiddleware
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder
+
+from app import database as db
+
+logger = logging.getLogger(__name__)
+
+# Через сколько секунд сбрасывать изменения, сделанные вне обработчиков апдейтов
+FLUSH_DELAY = 1.0
+# Сколько чистых (уже сохранённых) записей держать в памяти
+MAX_CACHED_RECORDS = 1000
+
+
+class _Record:
+    __slots__ = ('state', 'data')
+
+    def __init__(self, state=None, data=None):
+        self.state = state
+        self.data = data or {}
+
+
+class SQLiteStorage(BaseStorage):
+    """
+    FSM-хранилище aiogram поверх SQLite: состояние и данные переживают перезапуск.
+    Чтения обслуживаются из памяти, изменения помечаются «грязными» и пишутся
+    одной транзакцией в flush() — несколько update_data внутри одного
+    обработчика превращаются в одну запись.
+    """
+
+    def __init__(self):
+        self._key_builder = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        self._records = OrderedDict()
+        self._dirty = set()
+        # Записи, которые flush() сейчас пишет в БД: до коммита их нельзя вытеснять,
+        # иначе промах перечитает из БД старую версию
+        self._saving = set()
+        self._flush_lock = asyncio.Lock()
+        self._flush_task = None
+
+    async def _get_record(self, key):
+        storage_key = self._key_builder.build(key)
+        record = self._records.get(storage_key)
+        if record is None:
+            row = await db.get_fsm_record(storage_key)
+            if row:
+                record = _Record(row[0], json.loads(row[1]))
+            else:
+                record = _Record()
+            # Пока шёл запрос, запись мог создать конкурентный обработчик
+            record = self._records.setdefault(storage_key, record)
+            self._records.move_to_end(storage_key)
+            # Чтения для незнакомых пользователей тоже добавляют записи — вытесняем сразу
+            self._evict(keep=storage_key)
+        else:
+            self._records.move_to_end(storage_key)
+        return storage_key, record
+
+    def _mark_dirty(self, storage_key):
+        self._dirty.add(storage_key)
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._delayed_flush())
+
+    async def _delayed_flush(self):
+        await asyncio.sleep(FLUSH_DELAY)
+        await self.flush()
+
+    async def set_state(self, key, state=None):
+        storage_key, record = await self._get_record(key)
+        record.state = state.state if isinstance(state, State) else state
+        self._mark_dirty(storage_key)
+
+    async def get_state(self, key):
+        _, record = await self._get_record(key)
+        return record.state
+
+    async def set_data(self, key, data):
+        storage_key, record = await self._get_record(key)
+        record.data = data.copy()
+        self._mark_dirty(storage_key)
+
+    async def get_data(self, key):
+        _, record = await self._get_record(key)
+        return record.data.copy()
+
+    async def flush(self):
+        """
+        Записывает все изменённые записи одной транзакцией.
+        """
+        if not self._dirty:
+            return
+        async with self._flush_lock:
+            dirty, self._dirty = self._dirty, set()
+            records = []
+            for storage_key in dirty:
+                record = self._records.get(storage_key)
+                if record is None:
+                    continue
+                try:
+                    records.append((storage_key, record.state, json.dumps(record.data, ensure_ascii=False)))
+                except (TypeError, ValueError) as e:
+                    # Несериализуемые данные одной записи не должны блокировать остальные
+                    logger.error(f"Error serializing FSM data for {storage_key}: {e}")
+                    self._dirty.add(storage_key)
+            self._saving = {storage_key for storage_key, _, _ in records}
+            try:
+                await db.save_fsm_records(records)
+            except Exception as e:
+                logger.error(f"Error saving FSM storage: {e}")
+                self._dirty |= self._saving
+                return
+            finally:
+                self._saving = set()
+            self._evict()
+
+    def _evict(self, keep=None):
+        # Вытесняем самые давно использованные записи, которые уже сохранены
+        if len(self._records) <= MAX_CACHED_RECORDS:
+            return
+        for storage_key in list(self._records):
+            if len(self._records) <= MAX_CACHED_RECORDS:
+                break
+            if storage_key not in self._dirty and storage_key not in self._saving and storage_key != keep:
+                del self._records[storage_key]
+
+    async def close(self):
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+        await self.flush()
+
+
+class FSMFlushMiddleware(BaseMiddleware):
+    """
+    Сбрасывает изменения FSM после обработки каждого апдейта.
+    """
+
+    def __init__(self, storage):
+        self.storage = storage
+
+    async def __call__(self, handler, event, data):
+        try:
+            return await handler(event, data)
+        finally:
+            await self.storage.flush()
@@ -2,7 +2,7 @@ import asyncio
 from aiogram import Bot, Dispatcher, types
 from aiogram.filters import CommandStart, Text
 from aiogram.fsm.context import FSMContext
-from aiogram.fsm.storage.memory import MemoryStorage
+from app.fsm_storage import SQLiteStorage, FSMFlushMiddleware
 from aiogram.types import Message, CallbackQuery, ContentType
 from main import display_product
 from aiogram.utils.keyboard import ReplyKeyboardBuilder, InlineKeyboardBuilder
@@ -14,7 +14,9 @@ from app import database as db
 # Создаём бота и диспетчер
 BOT_TOKEN = os.getenv('BOT_TOKEN')
 bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
+storage = SQLiteStorage()
+dp = Dispatcher(storage=storage)
+dp.update.outer_middleware(FSMFlushMiddleware(storage))
 
 # Идентификатор администратора
 ADMIN_ID = int(os.getenv('ADMIN_ID'))
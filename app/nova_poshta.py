@@ -0,0 +1,90 @@
+# app/nova_poshta.py
+
+import asyncio
+import logging
+
+import aiohttp
+
+API_URL = "https://api.novaposhta.ua/v2.0/json/"
+
+# Явные таймауты: подключение, чтение ответа и общий предел на запрос
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=30, connect=5, sock_read=15)
+# Сколько держать открытым простаивающее соединение и кэшировать DNS (секунды)
+KEEPALIVE_TIMEOUT = 60
+DNS_CACHE_TTL = 600
+MAX_CONNECTIONS = 10
+# getStatusDocuments принимает не больше 100 документов за запрос
+TRACKING_BATCH_SIZE = 100
+
+logger = logging.getLogger(__name__)
+
+
+class NovaPoshtaClient:
+    """
+    Клиент API Новой Почты с одной долгоживущей aiohttp-сессией:
+    соединения с api.novaposhta.ua переиспользуются (keep-alive),
+    поэтому TCP и TLS рукопожатия не повторяются на каждый запрос.
+    Создаётся при старте бота (start), закрывается при остановке (close).
+    """
+
+    def __init__(self, api_key, timeout=REQUEST_TIMEOUT):
+        self.api_key = api_key
+        self.timeout = timeout
+        self._session = None
+
+    async def start(self):
+        if self._session is not None and not self._session.closed:
+            return
+        connector = aiohttp.TCPConnector(
+            limit=MAX_CONNECTIONS,
+            ttl_dns_cache=DNS_CACHE_TTL,
+            keepalive_timeout=KEEPALIVE_TIMEOUT,
+        )
+        self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+
+    async def close(self):
+        session, self._session = self._session, None
+        if session is not None and not session.closed:
+            await session.close()
+
+    async def call(self, model_name, called_method, method_properties):
+        """
+        Вызывает метод API и возвращает разобранный JSON-ответ.
+        Сетевые ошибки и таймауты пробрасываются вызывающему.
+        """
+        if self._session is None or self._session.closed:
+            await self.start()
+        payload = {
+            "apiKey": self.api_key,
+            "modelName": model_name,
+            "calledMethod": called_method,
+            "methodProperties": method_properties,
+        }
+        async with self._session.post(API_URL, json=payload) as resp:
+            return await resp.json()
+
+    async def get_status_documents(self, ttns):
+        """
+        Пакетный трекинг: делит TTN на запросы по TRACKING_BATCH_SIZE документов
+        и возвращает {TTN: документ}, сопоставляя ответы по полю Number.
+        TTN, по которым ответа нет (ошибка запроса), в результат не попадают.
+        """
+        ttns = list(dict.fromkeys(str(ttn) for ttn in ttns))
+        chunks = [ttns[i:i + TRACKING_BATCH_SIZE] for i in range(0, len(ttns), TRACKING_BATCH_SIZE)]
+        responses = await asyncio.gather(*(
+            self.call("TrackingDocument", "getStatusDocuments", {
+                "Documents": [{"DocumentNumber": ttn, "Phone": ""} for ttn in chunk]
+            })
+            for chunk in chunks
+        ), return_exceptions=True)
+
+        documents = {}
+        for chunk, response in zip(chunks, responses):
+            if isinstance(response, Exception):
+                logger.error(f"Помилка трекінгу {len(chunk)} ТТН: {response}")
+                continue
+            for doc in response.get('data') or []:
+                number = doc.get('Number')
+                if number:
+                    documents[str(number)] = doc
+        return documents
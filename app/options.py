@@ -0,0 +1,22 @@
+# app/options.py
+
+# Опции товара в фиксированном порядке: позиция в кортеже = номер бита в маске
+OPTION_KEYS = ('back_print', 'back_text', 'made_in_ukraine', 'collar', 'sleeve_text')
+
+
+def options_to_mask(options):
+    """
+    Кодирует dict выбранных опций в битовую маску.
+    """
+    mask = 0
+    for bit, key in enumerate(OPTION_KEYS):
+        if options.get(key):
+            mask |= 1 << bit
+    return mask
+
+
+def mask_to_options(mask):
+    """
+    Декодирует битовую маску обратно в dict {опция: bool}.
+    """
+    return {key: bool(mask & (1 << bit)) for bit, key in enumerate(OPTION_KEYS)}
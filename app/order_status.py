@@ -0,0 +1,76 @@
+# app/order_status.py
+
+from enum import IntEnum
+
+
+class OrderStatus(IntEnum):
+    """
+    Статус заказа. В БД хранится числом; номера не менять — только добавлять новые.
+    """
+    NEW = 0
+    AWAITING_PAYMENT_CONFIRMATION = 1
+    PAID = 2
+    PAYMENT_CONFIRMED = 3
+    PAYMENT_REJECTED = 4
+    READY = 5
+    SENT = 6
+    DELIVERED = 7
+    REJECTED = 8
+
+
+# Текст статуса для показа пользователю и администратору
+STATUS_TEXT = {
+    OrderStatus.NEW: 'Нове',
+    OrderStatus.AWAITING_PAYMENT_CONFIRMATION: 'Очікується підтвердження оплати',
+    OrderStatus.PAID: 'Оплачено',
+    OrderStatus.PAYMENT_CONFIRMED: 'Оплата підтверджена',
+    OrderStatus.PAYMENT_REJECTED: 'Оплата відхилена',
+    OrderStatus.READY: 'Готово до відправки',
+    OrderStatus.SENT: 'Відправлено',
+    OrderStatus.DELIVERED: 'Доставлено',
+    OrderStatus.REJECTED: 'Відхилено',
+}
+_STATUS_BY_TEXT = {text: status for status, text in STATUS_TEXT.items()}
+
+# Заказы в этих статусах больше не обрабатываются
+FINISHED_STATUSES = (OrderStatus.DELIVERED, OrderStatus.REJECTED)
+
+# Отметки на кнопках администратора: (ready, sent, delivered)
+_BUTTON_FLAGS = {
+    OrderStatus.READY: (True, False, False),
+    OrderStatus.SENT: (True, True, False),
+    OrderStatus.DELIVERED: (True, True, True),
+}
+
+
+def status_code(status):
+    """
+    Приводит статус (OrderStatus, число или текст) к OrderStatus.
+    """
+    if isinstance(status, str):
+        try:
+            return _STATUS_BY_TEXT[status]
+        except KeyError:
+            raise ValueError(f"Невідомий статус замовлення: {status}") from None
+    return OrderStatus(status)
+
+
+def status_text(status):
+    """
+    Текст статуса для показа; для неизвестного кода — сам код.
+    """
+    try:
+        return STATUS_TEXT[OrderStatus(status)]
+    except ValueError:
+        return str(status)
+
+
+def button_flags(status):
+    """
+    Какие кнопки администратора отмечены для статуса: {'ready', 'sent', 'delivered'}.
+    """
+    try:
+        ready, sent, delivered = _BUTTON_FLAGS.get(status_code(status), (False, False, False))
+    except ValueError:
+        ready = sent = delivered = False
+    return {'ready': ready, 'sent': sent, 'delivered': delivered}
@@ -0,0 +1,116 @@
+# app/photo_cache.py
+
+import logging
+from urllib.parse import urlsplit
+
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import InputMediaPhoto
+
+from app import database as db
+
+logger = logging.getLogger(__name__)
+
+# image_key -> Telegram file_id, загружается из БД при старте
+_file_ids = {}
+
+# Фрагменты ошибок Telegram о негодном file_id (в нижнем регистре)
+_FILE_ID_ERRORS = ('wrong file identifier', 'wrong remote file identifier', 'file_id', 'file reference')
+
+
+def image_key(url):
+    """
+    Стабильный ключ изображения. Ссылки Instagram CDN подписаны и меняют
+    хост и параметры запроса, а путь к файлу остаётся прежним.
+    """
+    parts = urlsplit(url)
+    return parts.path or url
+
+
+async def load():
+    """
+    Загружает сохранённые file_id из базы данных в память.
+    """
+    _file_ids.clear()
+    _file_ids.update(await db.get_photo_file_ids())
+    logger.info(f"Завантажено {len(_file_ids)} file_id зображень каталогу.")
+
+
+def resolve(url):
+    """
+    Возвращает file_id, если изображение уже загружалось в Telegram, иначе исходный URL.
+    """
+    return _file_ids.get(image_key(url), url)
+
+
+async def remember(url, message):
+    """
+    Запоминает file_id из ответа Telegram на отправку изображения.
+    """
+    if not message or not getattr(message, 'photo', None):
+        return
+    key = image_key(url)
+    file_id = message.photo[-1].file_id
+    if _file_ids.get(key) == file_id:
+        return
+    _file_ids[key] = file_id
+    try:
+        await db.save_photo_file_id(key, file_id)
+    except Exception as e:
+        logger.error(f"Error saving photo file_id: {e}")
+
+
+async def forget(url):
+    """
+    Удаляет file_id, который Telegram больше не принимает.
+    """
+    key = image_key(url)
+    if _file_ids.pop(key, None) is not None:
+        try:
+            await db.delete_photo_file_id(key)
+        except Exception as e:
+            logger.error(f"Error deleting photo file_id: {e}")
+
+
+def _is_file_id_error(error):
+    """
+    TelegramBadRequest относится именно к file_id, а не к подписи, клавиатуре и т.п.
+    """
+    message = (getattr(error, 'message', None) or str(error)).lower()
+    return any(marker in message for marker in _FILE_ID_ERRORS)
+
+
+async def _with_file_id(url, request):
+    """
+    Выполняет request(photo) с сохранённым file_id. Если Telegram отклонил
+    именно file_id, забывает его и один раз повторяет запрос с исходным URL.
+    """
+    photo = resolve(url)
+    try:
+        message = await request(photo)
+    except TelegramBadRequest as e:
+        if photo == url or not _is_file_id_error(e):
+            raise
+        logger.warning(f"Telegram не прийняв file_id для {image_key(url)}: {e.message}")
+        await forget(url)
+        message = await request(url)
+    await remember(url, message)
+    return message
+
+
+async def send_photo(bot, chat_id, url, **kwargs):
+    """
+    bot.send_photo с подстановкой сохранённого file_id вместо URL.
+    """
+    return await _with_file_id(url, lambda photo: bot.send_photo(chat_id, photo=photo, **kwargs))
+
+
+async def edit_photo(bot, chat_id, message_id, url, caption=None, parse_mode=None, reply_markup=None):
+    """
+    bot.edit_message_media с подстановкой сохранённого file_id вместо URL.
+    """
+    return await _with_file_id(url, lambda photo: bot.edit_message_media(
+        chat_id=chat_id,
+        message_id=message_id,
+        media=InputMediaPhoto(media=photo, caption=caption, parse_mode=parse_mode),
+        reply_markup=reply_markup
+    ))
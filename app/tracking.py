@@ -0,0 +1,332 @@
+# app/tracking.py
+
+import asyncio
+import calendar
+import heapq
+import logging
+import time
+from collections import OrderedDict
+from datetime import datetime
+
+from app import database as db
+
+logger = logging.getLogger(__name__)
+
+# Коды StatusCode из TrackingDocument.getStatusDocuments
+CREATED_CODES = {'1', '12'}                        # створено / комплектується
+IN_TRANSIT_CODES = {'4', '41', '5', '6', '101'}    # в дорозі між містами / відділеннями
+ARRIVED_CODES = {'7', '8'}                         # прибуло у відділення / поштомат
+RECEIVED_CODES = {'9', '10', '11'}                 # отримано
+NOT_FOUND_CODES = {'2', '3'}                       # видалено / не знайдено
+
+# Через сколько секунд перепроверять посылку в зависимости от её статуса
+ARRIVED_INTERVAL = 15 * 60
+CREATED_INTERVAL = 2 * 3600
+IN_TRANSIT_INTERVAL = 3 * 3600
+NOT_FOUND_INTERVAL = 6 * 3600
+DEFAULT_INTERVAL = 3600
+MAX_INTERVAL = 24 * 3600
+# Посылки старше этого возраста проверяются вдвое реже
+OLD_PARCEL_AGE = 14 * 24 * 3600
+
+# Как часто перечитывать из БД список активных заказов с TTN
+ORDERS_REFRESH_INTERVAL = 5 * 60
+# Сколько секунд статус из кэша считается свежим для обработчиков
+CACHE_TTL = 5 * 60
+# Сколько TTN держать в кэше; сверх лимита вытесняются давно не запрошенные
+CACHE_SIZE = 2000
+
+
+def is_received(doc):
+    """
+    Посылка получена: по StatusCode или по тексту статуса, как раньше.
+    """
+    return str(doc.get('StatusCode')) in RECEIVED_CODES or "Відправлення отримано" in doc.get('Status', '')
+
+
+def next_check_delay(status_code, age):
+    """
+    Через сколько секунд проверять посылку снова: часто, пока она ждёт
+    в отделении, редко, пока едет; старые посылки — ещё реже.
+    """
+    status_code = str(status_code) if status_code is not None else None
+    if status_code in ARRIVED_CODES:
+        delay = ARRIVED_INTERVAL
+    elif status_code in IN_TRANSIT_CODES:
+        delay = IN_TRANSIT_INTERVAL
+    elif status_code in CREATED_CODES:
+        delay = CREATED_INTERVAL
+    elif status_code in NOT_FOUND_CODES:
+        delay = NOT_FOUND_INTERVAL
+    else:
+        delay = DEFAULT_INTERVAL
+    if age is not None and age > OLD_PARCEL_AGE:
+        delay *= 2
+    return min(delay, MAX_INTERVAL)
+
+
+def parcel_age(doc, order, now=None):
+    """
+    Возраст посылки в секундах: по DateCreated из ответа НП,
+    а если его нет — по времени создания заказа.
+    """
+    now = now if now is not None else time.time()
+    created = None
+    if doc and doc.get('DateCreated'):
+        # DateCreated НП — местное время, как и у хоста бота
+        try:
+            created = datetime.strptime(doc['DateCreated'], '%d-%m-%Y %H:%M:%S').timestamp()
+        except (TypeError, ValueError):
+            created = None
+    if created is None and order:
+        # timestamp заказа — CURRENT_TIMESTAMP SQLite, то есть UTC
+        created = _utc_timestamp(order.get('timestamp'))
+    if created is None:
+        return None
+    return max(0.0, now - created)
+
+
+def _utc_timestamp(value):
+    """
+    Разбирает дату SQLite 'YYYY-MM-DD HH:MM:SS' (UTC) в секунды epoch; None, если не удалось.
+    """
+    if not value:
+        return None
+    try:
+        return calendar.timegm(time.strptime(value, '%Y-%m-%d %H:%M:%S'))
+    except (TypeError, ValueError):
+        return None
+
+
+def checked_at(order):
+    """
+    Время последней проверки заказа (np_checked_at, UTC) в секундах epoch или None.
+    """
+    return _utc_timestamp(order.get('np_checked_at'))
+
+
+class TrackingScheduler:
+    """
+    Очередь с приоритетом: для каждого TTN хранится время следующей проверки.
+    Перепланирование не удаляет старую запись из кучи — устаревшие записи
+    отбрасываются при извлечении (сверяются с _due).
+    """
+
+    def __init__(self):
+        self._heap = []
+        self._due = {}
+
+    def schedule(self, ttn, due):
+        self._due[ttn] = due
+        heapq.heappush(self._heap, (due, ttn))
+
+    def discard(self, ttn):
+        self._due.pop(ttn, None)
+
+    def __contains__(self, ttn):
+        return ttn in self._due
+
+    def __len__(self):
+        return len(self._due)
+
+    def next_due(self):
+        """
+        Ближайшее время проверки или None, если очередь пуста.
+        """
+        while self._heap:
+            due, ttn = self._heap[0]
+            if self._due.get(ttn) == due:
+                return due
+            heapq.heappop(self._heap)
+        return None
+
+    def pop_due(self, now):
+        """
+        Извлекает все TTN, время проверки которых наступило.
+        """
+        ready = []
+        while self._heap and self._heap[0][0] <= now:
+            due, ttn = heapq.heappop(self._heap)
+            if self._due.get(ttn) == due:
+                del self._due[ttn]
+                ready.append(ttn)
+        return ready
+
+
+class TrackingCache:
+    """
+    Кэш статусов посылок по TTN, общий для обработчиков и фонового трекера.
+    Свежий статус отдаётся сразу; устаревший — тоже сразу, а обновление
+    запускается в фоне. Одновременные промахи по одному TTN сводятся
+    к одному запросу к API. Размер ограничен size записями (LRU).
+    """
+
+    def __init__(self, client, ttl=CACHE_TTL, size=CACHE_SIZE):
+        self.client = client
+        self.ttl = ttl
+        self.size = size
+        self._entries = OrderedDict()
+        self._inflight = {}
+
+    def put(self, ttn, doc, fetched_at=None):
+        self._store(str(ttn), (fetched_at if fetched_at is not None else time.time(), doc))
+
+    def _store(self, ttn, entry):
+        self._entries[ttn] = entry
+        self._entries.move_to_end(ttn)
+        # Вытесняем самые давно использованные записи сверх лимита
+        while len(self._entries) > self.size:
+            self._entries.popitem(last=False)
+
+    def _refresh(self, ttn):
+        task = self._inflight.get(ttn)
+        if task is None:
+            task = asyncio.create_task(self._fetch(ttn))
+            self._inflight[ttn] = task
+            task.add_done_callback(lambda _: self._inflight.pop(ttn, None))
+        return task
+
+    async def _fetch(self, ttn):
+        documents = await self.client.get_status_documents([ttn])
+        doc = documents.get(ttn)
+        if doc:
+            self.put(ttn, doc)
+        return doc
+
+    async def get(self, ttn, order=None):
+        """
+        Возвращает документ трекинга для TTN или None, если статус получить не удалось.
+        order — заказ из БД: его сохранённый статус (np_status_*) используется,
+        пока в кэше ничего нет.
+        """
+        ttn = str(ttn)
+        entry = self._entries.get(ttn)
+        if entry is None and order and order.get('np_status_text'):
+            stored_at = checked_at(order)
+            if stored_at is not None:
+                entry = (stored_at, {
+                    'Number': ttn,
+                    'StatusCode': order.get('np_status_code'),
+                    'Status': order['np_status_text'],
+                })
+                self._store(ttn, entry)
+        if entry is not None:
+            self._entries.move_to_end(ttn)
+            fetched_at, doc = entry
+            if time.time() - fetched_at > self.ttl:
+                self._refresh(ttn)
+            return doc
+        # Промах: ждём общий запрос; отмена одного ожидающего не отменяет запрос для остальных
+        return await asyncio.shield(self._refresh(ttn))
+
+
+class Tracker:
+    """
+    Фоновый трекинг посылок Новой Почты по расписанию TrackingScheduler.
+    on_delivered(order, doc) вызывается, когда посылка получена.
+    Последний статус каждой посылки хранится в БД (np_status_code, np_status_text,
+    np_checked_at): смена статуса определяется сравнением с ним, а после
+    перезапуска расписание продолжается с момента последней проверки.
+    """
+
+    def __init__(self, client, on_delivered, cache=None):
+        self.client = client
+        self.on_delivered = on_delivered
+        # Результаты проверок попадают в общий кэш, из которого читают обработчики
+        self.cache = cache
+        self.scheduler = TrackingScheduler()
+        self._orders = {}
+        self._orders_loaded_at = None
+
+    async def refresh_orders(self, now):
+        """
+        Перечитывает активные заказы с TTN. Каждый TTN, которого нет в расписании,
+        планируется от сохранённой последней проверки (никогда не проверявшиеся —
+        сразу); завершённые и удалённые убираются из расписания.
+        """
+        orders = {}
+        async for order in db.iter_tracked_orders():
+            orders[str(order['ttn'])] = order
+        for ttn in self._orders.keys() - orders.keys():
+            self.scheduler.discard(ttn)
+        for ttn, order in orders.items():
+            if ttn not in self.scheduler:
+                self.scheduler.schedule(ttn, self._seed_due(order, now))
+        self._orders = orders
+        self._orders_loaded_at = now
+
+    @staticmethod
+    def _seed_due(order, now):
+        last_check = checked_at(order)
+        if last_check is None:
+            return now
+        return last_check + next_check_delay(order.get('np_status_code'), parcel_age(None, order, now))
+
+    async def check_due(self, now):
+        """
+        Одним пакетным запросом проверяет все TTN, время которых наступило,
+        и планирует следующую проверку каждого.
+        """
+        due = [ttn for ttn in self.scheduler.pop_due(now) if ttn in self._orders]
+        if not due:
+            return
+        # Извлечённые из очереди TTN обязаны вернуться в расписание, даже если проверка упала
+        handled = set()
+        try:
+            documents = await self.client.get_status_documents(due)
+
+            results = []
+            for ttn in due:
+                order = self._orders[ttn]
+                doc = documents.get(ttn)
+                if doc:
+                    code, text = str(doc.get('StatusCode', '')), doc.get('Status', '')
+                    if (code, text) != (order.get('np_status_code'), order.get('np_status_text')):
+                        logger.info(
+                            f"Заказ #{order['id']} (TTN {ttn}): статус НП "
+                            f"{order.get('np_status_text') or '—'} -> {text}"
+                        )
+                    order['np_status_code'], order['np_status_text'] = code, text
+                    results.append((order['id'], code, text))
+                    if self.cache is not None:
+                        self.cache.put(ttn, doc, now)
+
+                # Заказ ещё активен, значит доставку ещё не обработали — даже если статус не менялся
+                if doc and is_received(doc):
+                    del self._orders[ttn]
+                    handled.add(ttn)
+                    try:
+                        await self.on_delivered(order, doc)
+                    except Exception as e:
+                        logger.error(f"Ошибка обработки доставки заказа #{order['id']}: {e}")
+                    continue
+                status_code = doc.get('StatusCode') if doc else None
+                self.scheduler.schedule(ttn, now + next_check_delay(status_code, parcel_age(doc, order, now)))
+                handled.add(ttn)
+        finally:
+            for ttn in due:
+                if ttn not in handled and ttn in self._orders:
+                    self.scheduler.schedule(ttn, now + DEFAULT_INTERVAL)
+
+        # Статусы сохраняем одним пакетом уже после перепланирования: сбой записи
+        # не выбрасывает посылки из расписания, при следующей проверке запишем снова
+        try:
+            await db.save_tracking_results(results)
+        except Exception as e:
+            logger.error(f"Не вдалося зберегти статуси НП: {e}")
+
+    async def run(self):
+        while True:
+            now = time.time()
+            try:
+                if self._orders_loaded_at is None or now - self._orders_loaded_at >= ORDERS_REFRESH_INTERVAL:
+                    await self.refresh_orders(now)
+                await self.check_due(now)
+            except Exception as e:
+                logger.error(f"Ошибка трекинга Новой Почты: {e}")
+            # Спим до ближайшей проверки или до обновления списка заказов
+            wake_at = self._orders_loaded_at + ORDERS_REFRESH_INTERVAL if self._orders_loaded_at else now + 60
+            next_due = self.scheduler.next_due()
+            if next_due is not None:
+                wake_at = min(wake_at, next_due)
+            await asyncio.sleep(max(1.0, wake_at - time.time()))
@@ -1,7 +1,5 @@
 import asyncio
 from app.keep_alive import keep_alive
-import aiohttp
-import json
 import os
 import logging
 from datetime import datetime
@@ -17,16 +15,21 @@ from aiogram.types import (
     InlineKeyboardButton
 )
 from aiogram.fsm.context import FSMContext
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.fsm.state import StatesGroup, State
 from dotenv import load_dotenv
 
 from app import buttons as kb
 from app import database as db
+from app import photo_cache
+from app.fsm_storage import SQLiteStorage, FSMFlushMiddleware
+from app.order_status import button_flags
+from app.nova_poshta import NovaPoshtaClient
+from app import tracking
+from app.fetch_instagram import fetch_and_update_products, ensure_catalog_synced
 import asyncio
 import logging
 from aiogram import Bot
-from app.database import get_orders_not_delivered, update_order_status
+from app.database import update_order_status
 from app.database import get_order_by_id
 
 
@@ -35,8 +38,10 @@ load_dotenv()
 ADMIN_ID = int(os.environ.get("ADMIN_ID", 0))
 BOT_TOKEN = os.environ.get("BOT_TOKEN")
 bot = Bot(token=BOT_TOKEN)
-dp = Dispatcher(storage=MemoryStorage())
-PRODUCTS_JSON_PATH = 'app/products.json'
+# FSM хранится в SQLite, чтобы незавершённые заказы переживали перезапуск
+storage = SQLiteStorage()
+dp = Dispatcher(storage=storage)
+dp.update.outer_middleware(FSMFlushMiddleware(storage))
 
 # Определение состояний FSM
 class AdminTtnFlow(StatesGroup):
@@ -98,15 +103,10 @@ async def back_to_main(message: Message, state: FSMContext):
 # Обработка раздела "Мої замовлення"
 @dp.message(F.text == '📦 Мої замовлення')
 async def my_orders(message: Message):
-    orders = await db.get_orders_by_user(message.from_user.id)
-    if not orders:
-        await message.answer(
-            "🛒 У вас немає замовлень.",
-            reply_markup=kb.no_orders_menu()
-        )
-        return
-
-    for order in orders:
+    # История пользователя включает и архивные заказы; читаем её порциями
+    found = False
+    async for order in db.iter_orders_by_user(message.from_user.id, include_archive=True):
+        found = True
         order_text = await format_order_text(order, order['id'], message.from_user.username, message.from_user.id)
         status = order.get('status', '❓ Невідомий')
         await message.answer(
@@ -114,6 +114,12 @@ async def my_orders(message: Message):
             reply_markup=kb.order_details_button(order['id'])
         )
 
+    if not found:
+        await message.answer(
+            "🛒 У вас немає замовлень.",
+            reply_markup=kb.no_orders_menu()
+        )
+
 
 # Обработка кнопки "🛠️ Оформити замовлення в конструкторі"
 @dp.message(F.text == '🛠️ Оформити замовлення в конструкторі')
@@ -218,44 +224,41 @@ async def proceed_to_product(callback: CallbackQuery, state: FSMContext):
 
 
 # Функция для отображения продукта
-from aiogram.types import InputMediaPhoto
-
-
 async def display_product(user_id, state: FSMContext):
     data = await state.get_data()
     category = data.get('category')
     current_index = data.get('current_index', 0)
     current_color_index = data.get('current_color_index', 0)
 
-    if not os.path.exists(PRODUCTS_JSON_PATH):
-        await bot.send_message(user_id, "❌ Файла з товарами не знайдено.")
+    # Одна строка модели (индекс берётся по модулю числа моделей) и одна строка цвета
+    product = await db.get_catalog_product(category, current_index)
+    if not product:
+        await bot.send_message(user_id, "❌ У цій категорії поки немає товарів.")
         return
 
-    with open(PRODUCTS_JSON_PATH, 'r', encoding='utf-8') as f:
-        products = json.load(f)
-
-    category_products = products.get(category, [])
-    total_products = len(category_products)
-
-    if current_index < 0 or current_index >= total_products:
-        current_index = 0
+    total_products = product['total_products']
+    if current_index != product['position']:
+        current_index = product['position']
         await state.update_data(current_index=current_index)
 
-    product = category_products[current_index]
     model_name = product.get('model_name')
-    colors = product.get('colors', [])
-    total_colors = len(colors)
+    total_colors = product['color_count']
 
-    if current_color_index < 0 or current_color_index >= total_colors:
-        current_color_index = 0
+    if total_colors and not 0 <= current_color_index < total_colors:
+        current_color_index %= total_colors
         await state.update_data(current_color_index=current_color_index)
 
-    selected_color_url = colors[current_color_index]
+    color = await db.get_product_color(product['model_id'], current_color_index)
+    selected_color_url = color['media_url'] if color else "https://i.ibb.co/cx351Lx/1-2.png"
     # Для футболок добавляем cache buster
     image_url = selected_color_url
 
 
-    await state.update_data(selected_product=product, selected_color_index=current_color_index)
+    await state.update_data(
+        selected_product=product,
+        selected_color_index=current_color_index,
+        selected_color_media_id=color['media_id'] if color else None
+    )
 
     price, discount_text = await calculate_price(product, user_id)
     await state.update_data(price=price)
@@ -300,19 +303,23 @@ async def display_product(user_id, state: FSMContext):
     product_message_id = data.get('product_message_id')
     if product_message_id:
         try:
-            await bot.edit_message_media(
+            await photo_cache.edit_photo(
+                bot,
                 chat_id=user_id,
                 message_id=product_message_id,
-                media=InputMediaPhoto(media=image_url, caption=order_summary, parse_mode='Markdown'),
+                url=image_url,
+                caption=order_summary,
+                parse_mode='Markdown',
                 reply_markup=keyboard
             )
         except Exception as e:
             logger.error(f"Error editing product photo: {e}")
     else:
         try:
-            msg = await bot.send_photo(
+            msg = await photo_cache.send_photo(
+                bot,
                 user_id,
-                photo=image_url,
+                image_url,
                 caption=order_summary,
                 reply_markup=keyboard,
                 parse_mode='Markdown'
@@ -331,25 +338,11 @@ async def paginate_products(callback: CallbackQuery, state: FSMContext):
     current_index = data.get('current_index', 0)
     current_color_index = 0
 
-    if not os.path.exists(PRODUCTS_JSON_PATH):
-        await bot.send_message(callback.from_user.id, "❌ Файла з товарами не знайдено.")
-        await callback.answer()
-        return
-
-    with open(PRODUCTS_JSON_PATH, 'r', encoding='utf-8') as f:
-        products = json.load(f)
-
-    category_products = products.get(category, [])
-    total_products = len(category_products)
-
+    # Выход за границы обрабатывает display_product: позиция берётся по модулю числа моделей
     if callback.data == 'next_product':
         current_index += 1
-        if current_index >= total_products:
-            current_index = 0
     elif callback.data == 'prev_product':
         current_index -= 1
-        if current_index < 0:
-            current_index = total_products - 1
 
     await state.update_data(current_index=current_index, current_color_index=current_color_index)
 
@@ -365,29 +358,11 @@ async def paginate_colors(callback: CallbackQuery, state: FSMContext):
     current_index = data.get('current_index', 0)
     current_color_index = data.get('current_color_index', 0)
 
-    if not os.path.exists(PRODUCTS_JSON_PATH):
-        await bot.send_message(callback.from_user.id, "❌ Файла з товарами не знайдено.")
-        await callback.answer()
-        return
-
-    with open(PRODUCTS_JSON_PATH, 'r', encoding='utf-8') as f:
-        products = json.load(f)
-
-    category_products = products.get(category, [])
-    total_products = len(category_products)
-
-    product = category_products[current_index]
-    colors = product.get('colors', [])
-    total_colors = len(colors)
-
+    # Выход за границы обрабатывает display_product: индекс берётся по модулю числа цветов
     if callback.data == 'next_color':
         current_color_index += 1
-        if current_color_index >= total_colors:
-            current_color_index = 0
     elif callback.data == 'prev_color':
         current_color_index -= 1
-        if current_color_index < 0:
-            current_color_index = total_colors - 1
 
     await state.update_data(current_color_index=current_color_index)
 
@@ -405,33 +380,30 @@ async def select_product(callback: CallbackQuery, state: FSMContext):
     current_color_index = data.get('current_color_index', 0)
     selected_options = data.get('options', {})
 
-    if not os.path.exists(PRODUCTS_JSON_PATH):
-        await bot.send_message(callback.from_user.id, "❌ Файла з товарами не знайдено.")
+    product = await db.get_catalog_product(category, current_index)
+    if not product:
+        await bot.send_message(callback.from_user.id, "❌ У цій категорії поки немає товарів.")
         await callback.answer()
         return
 
-    with open(PRODUCTS_JSON_PATH, 'r', encoding='utf-8') as f:
-        products = json.load(f)
-
-    category_products = products.get(category, [])
-    total_products = len(category_products)
-
-    if current_index < 0 or current_index >= total_products:
-        await state.update_data(current_index=0)
-        current_index = 0
+    if current_index != product['position']:
+        current_index = product['position']
+        await state.update_data(current_index=current_index)
 
-    product = category_products[current_index]
     model_name = product.get('model_name')
-    colors = product.get('colors', [])
-    total_colors = len(colors)
+    total_colors = product['color_count']
 
-    if current_color_index < 0 or current_color_index >= total_colors:
-        current_color_index = 0
+    if total_colors and not 0 <= current_color_index < total_colors:
+        current_color_index %= total_colors
         await state.update_data(current_color_index=current_color_index)
 
-    selected_color_url = colors[current_color_index]
-
-    await state.update_data(selected_product=product, selected_color_index=current_color_index)
+    # Индекс и media id цвета берём из одной строки: каталог мог обновиться после показа
+    color = await db.get_product_color(product['model_id'], current_color_index)
+    await state.update_data(
+        selected_product=product,
+        selected_color_index=current_color_index,
+        selected_color_media_id=color['media_id'] if color else None
+    )
     await state.update_data(product_message_id=None)
 
     price, discount_text = await calculate_price(product, callback.from_user.id)
@@ -537,21 +509,23 @@ async def order_phone(message: Message, state: FSMContext):
             'collar': data.get('options', {}).get('collar', False),
             'sleeve_text': data.get('options', {}).get('sleeve_text', False),
             'price': data.get('price'),
-            'selected_color_index': data.get('selected_color_index', 0)
+            'selected_color_index': data.get('selected_color_index', 0),
+            'selected_color_media_id': data.get('selected_color_media_id')
         }
 
-        order_id = await db.save_order(message.from_user.id, order_data)
+        order = await db.create_order(message.from_user.id, order_data)
+        order_id = order['id']
 
         await message.answer("✅ Ваше замовлення прийнято та буде оброблено найближчим часом. Дякуємо!")
         await state.clear()
 
-        order = await db.get_order_by_id(order_id)
         order_text = await format_order_text(order, order_id, message.from_user.username, message.from_user.id)
         image_url = await get_order_image_url(order)
         statuses = get_statuses_from_order_status(order['status'])
-        admin_message = await bot.send_photo(
+        admin_message = await photo_cache.send_photo(
+            bot,
             ADMIN_ID,
-            photo=image_url,
+            image_url,
             caption=f"📦 **Нове замовлення #{order_id}** від @{message.from_user.username}:\n{order_text}",
             reply_markup=kb.admin_order_actions(order_id, statuses=statuses)
         )
@@ -603,10 +577,12 @@ async def receive_payment_screenshot(message: Message, state: FSMContext):
         'collar': data.get('options', {}).get('collar', False),
         'sleeve_text': data.get('options', {}).get('sleeve_text', False),
         'price': data.get('price'),
-        'selected_color_index': data.get('selected_color_index', 0)
+        'selected_color_index': data.get('selected_color_index', 0),
+        'selected_color_media_id': data.get('selected_color_media_id')
     }
 
-    order_id = await db.save_order(message.from_user.id, order_data)
+    order = await db.create_order(message.from_user.id, order_data)
+    order_id = order['id']
 
     admin_message = await bot.send_photo(
         ADMIN_ID,
@@ -941,45 +917,8 @@ async def format_order_text(order, order_id, username, user_id):
 
 # Функция для получения статусов кнопок на основе статуса заказа
 def get_statuses_from_order_status(order_status):
-    statuses = {
-        'ready': False,
-        'sent': False,
-        'delivered': False
-    }
-    if order_status in ['Нове', 'Оплата підтверджена', 'Очікується підтвердження оплати', 'Оплачено']:
-        statuses['ready'] = False
-    elif order_status == 'Готово до відправки':
-        statuses['ready'] = True
-    elif order_status == 'Відправлено':
-        statuses['ready'] = True
-        statuses['sent'] = True
-    elif order_status == 'Доставлено':
-        statuses['ready'] = True
-        statuses['sent'] = True
-        statuses['delivered'] = True
-    return statuses
-
-
-# Функция для получения URL изображения заказа
-async def get_order_image_url(order):
-    if not os.path.exists(PRODUCTS_JSON_PATH):
-        return "https://i.ibb.co/cx351Lx/1-2.png"
-
-    with open(PRODUCTS_JSON_PATH, 'r', encoding='utf-8') as f:
-        products = json.load(f)
-    category = 't_shirts' if order['product'].startswith('ts') else 'hoodies'
-    category_products = products.get(category, [])
-    product_data = next((p for p in category_products if p['model_id'] == order['product']), None)
-    if not product_data:
-        image_url = "https://i.ibb.co/cx351Lx/1-2.png"
-    else:
-        selected_color_index = order.get('selected_color_index', 0)
-        colors = product_data['colors']
-        if colors:
-            image_url = colors[selected_color_index % len(colors)]
-        else:
-            image_url = "https://i.ibb.co/cx351Lx/1-2.png"
-    return image_url
+    # Отметки кнопок берутся из таблицы статусов app.order_status
+    return button_flags(order_status)
 
 
 # Обработка раздела "🔥 Мої акції та знижки"
@@ -1169,18 +1108,26 @@ async def admin_orders(message: Message):
         )
 
 
-# Обработка кнопки "📂 Замовлення в обробці"
-@dp.message(F.text == '📂 Замовлення в обробці')
-async def processing_orders(message: Message):
-    if message.from_user.id == ADMIN_ID:
-        orders = await db.get_orders_not_delivered()
-        if not orders:
-            await message.answer('Немає замовлень в обробці.', reply_markup=kb.admin_main_menu())
-            return
+async def send_admin_orders_page(chat_id, view, after_id=None, before_id=None):
+    """
+    Отправляет администратору одну страницу заказов и сообщение с кнопками
+    перехода между страницами. view: 'processing' — заказы в обработке,
+    'completed' — выполненные. Возвращает False, если страница пуста.
+    """
+    if view == 'processing':
+        orders, has_prev, has_next = await db.get_orders_not_delivered_page(after_id, before_id)
+    else:
+        orders, has_prev, has_next = await db.get_orders_by_status_page(
+            'Доставлено', after_id, before_id, include_archive=True
+        )
+    if not orders:
+        return False
 
+    # message_id сообщений сохраняем одним пакетом после отправки
+    admin_message_ids = []
+    try:
         for order in orders:
             order_text = await format_order_text(order, order['id'], '', order['user_id'])
-            statuses = get_statuses_from_order_status(order['status'])
             image_url = await get_order_image_url(order)
             user_username = ''
             try:
@@ -1188,39 +1135,73 @@ async def processing_orders(message: Message):
                 user_username = f"@{user_chat.username}" if user_chat.username else user_chat.full_name
             except Exception:
                 user_username = f"User ID: {order['user_id']}"
-            admin_message = await bot.send_photo(
-                message.from_user.id,
-                photo=image_url,
-                caption=f"📦 Замовлення #{order['id']} від {user_username}:\n{order_text}",
-                reply_markup=kb.admin_order_actions(order['id'], statuses=statuses)
-            )
-            await db.save_order_admin_message_id(order['id'], admin_message.message_id)
+            if view == 'processing':
+                statuses = get_statuses_from_order_status(order['status'])
+                admin_message = await photo_cache.send_photo(
+                    bot,
+                    chat_id,
+                    image_url,
+                    caption=f"📦 Замовлення #{order['id']} від {user_username}:\n{order_text}",
+                    reply_markup=kb.admin_order_actions(order['id'], statuses=statuses)
+                )
+                admin_message_ids.append((order['id'], admin_message.message_id))
+            else:
+                await photo_cache.send_photo(
+                    bot,
+                    chat_id,
+                    image_url,
+                    caption=f"✅ Виконане замовлення #{order['id']} від {user_username}:\n{order_text}",
+                    reply_markup=None
+                )
+    finally:
+        await db.save_order_admin_message_ids(admin_message_ids)
+
+    pagination = kb.admin_orders_pagination(view, orders[0]['id'], orders[-1]['id'], has_prev, has_next)
+    if pagination:
+        await bot.send_message(
+            chat_id,
+            f"Замовлення #{orders[0]['id']}–#{orders[-1]['id']}",
+            reply_markup=pagination
+        )
+    return True
+
+
+# Обработка кнопки "📂 Замовлення в обробці"
+@dp.message(F.text == '📂 Замовлення в обробці')
+async def processing_orders(message: Message):
+    if message.from_user.id == ADMIN_ID:
+        if not await send_admin_orders_page(message.from_user.id, 'processing'):
+            await message.answer('Немає замовлень в обробці.', reply_markup=kb.admin_main_menu())
 
 
 # Обработка кнопки "📂 Виконані замовлення"
 @dp.message(F.text == '📂 Виконані замовлення')
 async def completed_orders(message: Message):
     if message.from_user.id == ADMIN_ID:
-        orders = await db.get_orders_by_status('Доставлено')
-        if not orders:
+        if not await send_admin_orders_page(message.from_user.id, 'completed'):
             await message.answer('Немає виконаних замовлень.', reply_markup=kb.admin_main_menu())
-            return
 
-        for order in orders:
-            order_text = await format_order_text(order, order['id'], '', order['user_id'])
-            image_url = await get_order_image_url(order)
-            user_username = ''
-            try:
-                user_chat = await bot.get_chat(order['user_id'])
-                user_username = f"@{user_chat.username}" if user_chat.username else user_chat.full_name
-            except Exception:
-                user_username = f"User ID: {order['user_id']}"
-            await bot.send_photo(
-                message.from_user.id,
-                photo=image_url,
-                caption=f"✅ Виконане замовлення #{order['id']} від {user_username}:\n{order_text}",
-                reply_markup=None
-            )
+
+# Переход между страницами заказов: admin_page_{view}_{next|prev}_{id}
+@dp.callback_query(F.data.startswith('admin_page_'))
+async def admin_orders_page(callback: CallbackQuery):
+    if callback.from_user.id != ADMIN_ID:
+        await callback.answer()
+        return
+    _, _, view, direction, order_id = callback.data.split('_')
+    order_id = int(order_id)
+    await callback.answer()
+    # Кнопки старой страницы больше не нужны
+    try:
+        await callback.message.edit_reply_markup(reply_markup=None)
+    except Exception:
+        pass
+    if direction == 'next':
+        found = await send_admin_orders_page(callback.from_user.id, view, after_id=order_id)
+    else:
+        found = await send_admin_orders_page(callback.from_user.id, view, before_id=order_id)
+    if not found:
+        await callback.message.answer('Більше замовлень немає.', reply_markup=kb.admin_main_menu())
 
 
 @dp.callback_query(F.data.startswith('order_'))
@@ -1271,6 +1252,9 @@ async def admin_order_action(callback: CallbackQuery, state: FSMContext):
         if not order:
             await callback.answer('Замовлення не знайдено.')
             return
+        if order.get('archived'):
+            await callback.answer('Замовлення вже в архіві, змінити його не можна.', show_alert=True)
+            return
 
         # Переход к FSM AdminTtnFlow:
         #  1) сохраним order_id в state
@@ -1307,6 +1291,10 @@ async def admin_order_action(callback: CallbackQuery, state: FSMContext):
     if not order:
         await callback.answer('Замовлення не знайдено.')
         return
+    # Архивные заказы только просматриваются: изменения применяются лишь к таблице orders
+    if order.get('archived') and main_action != 'details':
+        await callback.answer('Замовлення вже в архіві, змінити його не можна.', show_alert=True)
+        return
 
     user_id = order['user_id']
     admin_message_id = order.get('admin_message_id')
@@ -1347,7 +1335,7 @@ async def admin_order_action(callback: CallbackQuery, state: FSMContext):
                 f"TTN: Немає\n"
             )
         else:
-            np_status = await get_nova_poshta_status(ttn)  # ваша функция трекинга
+            np_status = await get_nova_poshta_status(ttn, order)  # из кэша трекинга
             message_text = (
                 f"{order_text}\n\n"
                 f"📦 **Статус НП**: {np_status}\n"
@@ -1390,6 +1378,12 @@ async def admin_receive_ttn(message: Message, state: FSMContext):
         await message.answer("❌ Номер ТТН не може бути порожнім.")
         return
 
+    order = await db.get_order_by_id(order_id)
+    if not order or order.get('archived'):
+        await message.answer("❌ Замовлення не знайдено або вже в архіві.")
+        await state.clear()
+        return
+
     await db.update_order_ttn(order_id, ttn)
     await db.update_order_status(order_id, 'Відправлено')
     await bot.send_message(user_id, f"Ваше замовлення #{order_id} відправлено.\nНомер ТТН: {ttn}")
@@ -1419,10 +1413,26 @@ async def main():
 # Фоновая задача для обновления продуктов
 async def background_task():
     while True:
-        fetch_and_update_products()
+        try:
+            # Синхронизация асинхронная и не блокирует обработку апдейтов
+            await fetch_and_update_products()
+        except Exception as e:
+            logger.error(f"Ошибка в background_task: {e}")
         await asyncio.sleep(1200)
 
 
+# Фоновая задача переноса старых завершённых заказов в архив
+async def archive_orders_task():
+    while True:
+        try:
+            moved = await db.archive_finished_orders()
+            if moved:
+                logger.info(f"Перенесено в архів замовлень: {moved}")
+        except Exception as e:
+            logger.error(f"Ошибка в archive_orders_task: {e}")
+        await asyncio.sleep(6 * 3600)
+
+
 async def on_startup(dp: Dispatcher):
     asyncio.create_task(background_task())
     logger.info(f"[{datetime.now()}] Фоновая задача для оновлення продуктів запущена.")
@@ -1471,9 +1481,10 @@ async def process_order_for_admin(order_id, user_username, user_id):
     order_text = await format_order_text(order, order_id, user_username, user_id)
     statuses = get_statuses_from_order_status(order['status'])
     image_url = await get_order_image_url(order)
-    admin_message = await bot.send_photo(
+    admin_message = await photo_cache.send_photo(
+        bot,
         ADMIN_ID,
-        photo=image_url,
+        image_url,
         caption=f"📦 **Замовлення #{order_id}** від {user_username}:\n{order_text}",
         reply_markup=kb.admin_order_actions(order_id, statuses=statuses)
     )
@@ -1608,72 +1619,39 @@ async def format_order_text(order, order_id, username, user_id):
 
 
 def get_statuses_from_order_status(order_status):
-    statuses = {'ready': False, 'sent': False, 'delivered': False}
-    if order_status in ['Нове', 'Оплата підтверджена', 'Очікується підтвердження оплати', 'Оплачено']:
-        statuses['ready'] = False
-    elif order_status == 'Готово до відправки':
-        statuses['ready'] = True
-    elif order_status == 'Відправлено':
-        statuses['ready'] = True
-        statuses['sent'] = True
-    elif order_status == 'Доставлено':
-        statuses['ready'] = True
-        statuses['sent'] = True
-        statuses['delivered'] = True
-    return statuses
+    # Отметки кнопок берутся из таблицы статусов app.order_status
+    return button_flags(order_status)
 
 
 async def get_order_image_url(order):
-    if not os.path.exists(PRODUCTS_JSON_PATH):
-        return "https://i.ibb.co/cx351Lx/1-2.png"
-    with open(PRODUCTS_JSON_PATH, 'r', encoding='utf-8') as f:
-        products = json.load(f)
-    category = 't_shirts' if order['product'].startswith('ts') else 'hoodies'
-    category_products = products.get(category, [])
-    product_data = next((p for p in category_products if p['model_id'] == order['product']), None)
-    if product_data:
-        colors = product_data.get('colors', [])
-        index = order.get('selected_color_index', 0)
-        if colors and 0 <= index < len(colors):
-            return colors[index]
-    return "https://i.ibb.co/cx351Lx/1-2.png"
+    # Изображение берётся из product_colors — тех же таблиц, из которых показывается каталог
+    media_id = order.get('selected_color_media_id')
+    if media_id:
+        # Цвет ищем по media id: позиции сдвигаются, когда из поста удаляют фото
+        color = await db.get_product_color_by_media_id(order['product'], media_id)
+    else:
+        # Заказы до сохранения media id — по позиции цвета
+        color = await db.get_product_color(order['product'], order.get('selected_color_index', 0))
+    return color['media_url'] if color else "https://i.ibb.co/cx351Lx/1-2.png"
 
 NOVA_POSHTA_API_KEY = os.environ.get("NOVA_POSHTA_API_KEY")
+# Один клиент с общей сессией на всё время работы бота
+nova_poshta = NovaPoshtaClient(NOVA_POSHTA_API_KEY)
+# Статусы посылок: общий кэш для обработчиков и фонового трекера
+tracking_cache = tracking.TrackingCache(nova_poshta)
 
-async def get_nova_poshta_status(ttn: str) -> str:
+async def get_nova_poshta_status(ttn: str, order=None) -> str:
     """
-    Делает запрос к API Новой Почты, возвращает строку со статусом посылки.
+    Возвращает строку со статусом посылки из общего кэша трекинга:
+    устаревший статус обновляется в фоне, в API идём только при промахе.
     Если не удалось получить статус — возвращает текст об ошибке.
     """
-    url = "https://api.novaposhta.ua/v2.0/json/"
-    payload = {
-        "apiKey": NOVA_POSHTA_API_KEY,
-        "modelName": "TrackingDocument",
-        "calledMethod": "getStatusDocuments",
-        "methodProperties": {
-            "Documents": [
-                {
-                    "DocumentNumber": ttn,
-                    "Phone": ""  # Можно указать телефон, если хотите
-                }
-            ]
-        }
-    }
-
-    try:
-        async with aiohttp.ClientSession() as session:
-            async with session.post(url, json=payload) as resp:
-                data = await resp.json()
-                # Ожидаем, что data['data'] — список документов
-                doc_info = data.get('data', [])
-                if not doc_info:
-                    return "Не вдалося отримати дані від Нової Пошти."
-                doc = doc_info[0]
-                # Из doc можно достать много полей:
-                #   Status, StatusCode, WarehouseRecipientAddress, DeliveryDate, RecipientDateTime и т.д.
-                return doc.get('Status', 'Статус невідомий')
-    except Exception as e:
-        return f"Помилка з'єднання з Новою Поштою: {e}"
+    doc = await tracking_cache.get(ttn, order)
+    if not doc:
+        return "Не вдалося отримати дані від Нової Пошти."
+    # Из doc можно достать много полей:
+    #   Status, StatusCode, WarehouseRecipientAddress, DeliveryDate, RecipientDateTime и т.д.
+    return doc.get('Status') or 'Статус невідомий'
 
 
 @dp.callback_query(F.data.startswith('order_details_'))
@@ -1706,7 +1684,7 @@ async def order_details_callback(callback: CallbackQuery, state: FSMContext):
         await callback.message.answer(message_text, parse_mode='Markdown')
     else:
         # Если TTN есть, обращаемся к API Новой Почты
-        np_status = await get_nova_poshta_status(ttn)  # ваша функция запроса
+        np_status = await get_nova_poshta_status(ttn, order)  # из кэша трекинга
         message_text = (
             f"{order_text}\n\n"
             f"📦 **Статус з Нової Пошти:** {np_status}\n"
@@ -1717,54 +1695,49 @@ async def order_details_callback(callback: CallbackQuery, state: FSMContext):
     # Обязательный ответ колбэку, чтобы Telegram не думал, что бот завис
     await callback.answer()
 
+async def mark_order_delivered(order, doc=None):
+    """
+    Переводит заказ в 'Доставлено' и уведомляет пользователя и администратора.
+    """
+    order_id = order['id']
+    ttn = order.get('ttn')
+    # 1) Ставим статус 'Доставлено'
+    await update_order_status(order_id, 'Доставлено')
+
+    # 2) Уведомляем пользователя
+    user_id = order['user_id']
+    user_message = (
+        f"Дякуємо, що обрали наш магазин!\n"
+        f"Ваше замовлення #{order_id} з номером ТТН {ttn} щойно було отримано "
+        f"у відділенні Нової Пошти. Бажаємо приємного користування!"
+    )
+    try:
+        await bot.send_message(user_id, user_message)
+    except Exception as e:
+        logging.error(f"Не вдалося відправити повідомлення користувачу {user_id}: {e}")
+
+    # 3) Уведомляем администратора
+    admin_message = (
+        f"Замовлення #{order_id} з TTN: {ttn} "
+        f"отримано користувачем і переведено в статус 'Доставлено'."
+    )
+    try:
+        await bot.send_message(ADMIN_ID, admin_message)
+    except Exception as e:
+        logging.error(f"Не вдалося відправити повідомлення адміністратору: {e}")
+
+    logging.info(f"Заказ #{order_id} (TTN {ttn}) переведён в 'Доставлено'")
+
+
 async def auto_check_nova_poshta():
     """
-    Раз в час проверяем все заказы со статусом != 'Доставлено' и != 'Відхилено',
-    у которых есть TTN. Если 'Відправлення отримано' — ставим 'Доставлено',
+    Фоновый трекинг заказов со статусом != 'Доставлено' и != 'Відхилено', у которых есть TTN.
+    Каждая посылка проверяется по своему расписанию (app.tracking): часто, пока ждёт
+    в отделении, редко, пока едет. Когда посылка получена — ставим 'Доставлено',
     пишем пользователю и админу.
     """
-    while True:
-        try:
-            orders = await get_orders_not_delivered()  # все, у кого status != 'Доставлено' / 'Відхилено'
-            for order in orders:
-                order_id = order['id']
-                ttn = order.get('ttn')
-                if not ttn:
-                    continue  # нет TTN — пропускаем
-
-                np_status = await get_nova_poshta_status(ttn)
-                if "Відправлення отримано" in np_status:
-                    # 1) Ставим статус 'Доставлено'
-                    await update_order_status(order_id, 'Доставлено')
-
-                    # 2) Уведомляем пользователя
-                    user_id = order['user_id']
-                    user_message = (
-                        f"Дякуємо, що обрали наш магазин!\n"
-                        f"Ваше замовлення #{order_id} з номером ТТН {ttn} щойно було отримано "
-                        f"у відділенні Нової Пошти. Бажаємо приємного користування!"
-                    )
-                    try:
-                        await bot.send_message(user_id, user_message)
-                    except Exception as e:
-                        logging.error(f"Не вдалося відправити повідомлення користувачу {user_id}: {e}")
-
-                    # 3) Уведомляем администратора
-                    admin_message = (
-                        f"Замовлення #{order_id} з TTN: {ttn} "
-                        f"отримано користувачем і переведено в статус 'Доставлено'."
-                    )
-                    try:
-                        await bot.send_message(ADMIN_ID, admin_message)
-                    except Exception as e:
-                        logging.error(f"Не вдалося відправити повідомлення адміністратору: {e}")
-
-                    logging.info(f"Заказ #{order_id} (TTN {ttn}) переведён в 'Доставлено'")
-        except Exception as e:
-            logging.error(f"Ошибка в auto_check_nova_poshta: {e}")
-
-        # Ждём 1 час и повторяем
-        await asyncio.sleep(3600)
+    tracker = tracking.Tracker(nova_poshta, mark_order_delivered, cache=tracking_cache)
+    await tracker.run()
 
 @dp.callback_query(F.data.startswith('order_create_ttn_'))
 async def admin_create_ttn_start(callback: CallbackQuery, state: FSMContext):
@@ -1896,8 +1869,8 @@ async def admin_confirm_ttn(callback: CallbackQuery, state: FSMContext):
     data = await state.get_data()
     order_id = data['order_id']
     order = await db.get_order_by_id(order_id)
-    if not order:
-        await callback.answer("Замовлення не знайдено.", show_alert=True)
+    if not order or order.get('archived'):
+        await callback.answer("Замовлення не знайдено або вже в архіві.", show_alert=True)
         await state.clear()
         return
 
@@ -1990,40 +1963,32 @@ async def create_nova_poshta_document(user_data, sender_data, payer_type, cost,
 
     Возвращает (ttn, None) или (None, error_message)
     """
-    import aiohttp
-
-    url = "https://api.novaposhta.ua/v2.0/json/"
-    payload = {
-        "apiKey": NOVA_POSHTA_API_KEY,  # из .env
-        "modelName": "InternetDocument",
-        "calledMethod": "save",
-        "methodProperties": {
-            "NewAddress": "1",
-            "PayerType": payer_type,       # "Recipient" / "Sender"
-            "PaymentMethod": "Cash",
-            "CargoType": "Cargo",
-            "VolumeGeneral": "0.1",
-            "Weight": "1",
-            "ServiceType": "WarehouseWarehouse",
-            "SeatsAmount": "1",
-            "Description": "Замовлення з бота",
-            "Cost": cost,  # объявленная стоимость
-            "CitySender": sender_data['sender_city'],  # упрощённо: "м.Київ", но по-хорошему нужен Ref
-            "SenderAddress": f"відділення {sender_data['sender_branch']}",
-            "SendersPhone": sender_data['sender_phone'],
-            "Sender": sender_data['sender_name'],
-
-            "RecipientName": user_data['fullname'],
-            "RecipientPhone": user_data['phone'],
-            "RecipientCityName": f"м.{user_data['city']}",
-            "RecipientAddressName": f"відділення №{user_data['branch']}",
-            "RecipientType": "PrivatePerson"
-        }
+    method_properties = {
+        "NewAddress": "1",
+        "PayerType": payer_type,       # "Recipient" / "Sender"
+        "PaymentMethod": "Cash",
+        "CargoType": "Cargo",
+        "VolumeGeneral": "0.1",
+        "Weight": "1",
+        "ServiceType": "WarehouseWarehouse",
+        "SeatsAmount": "1",
+        "Description": "Замовлення з бота",
+        "Cost": cost,  # объявленная стоимость
+        "CitySender": sender_data['sender_city'],  # упрощённо: "м.Київ", но по-хорошему нужен Ref
+        "SenderAddress": f"відділення {sender_data['sender_branch']}",
+        "SendersPhone": sender_data['sender_phone'],
+        "Sender": sender_data['sender_name'],
+
+        "RecipientName": user_data['fullname'],
+        "RecipientPhone": user_data['phone'],
+        "RecipientCityName": f"м.{user_data['city']}",
+        "RecipientAddressName": f"відділення №{user_data['branch']}",
+        "RecipientType": "PrivatePerson"
     }
 
     # Если наложка, указываем BackwardDeliveryData
     if backward_delivery:
-        payload["methodProperties"]["BackwardDeliveryData"] = [
+        method_properties["BackwardDeliveryData"] = [
             {
                 "PayerType": "Recipient",
                 "CargoType": "Money",
@@ -2031,37 +1996,46 @@ async def create_nova_poshta_document(user_data, sender_data, payer_type, cost,
             }
         ]
 
-    async with aiohttp.ClientSession() as session:
-        async with session.post(url, json=payload) as resp:
-            data = await resp.json()
-            if not data.get('success'):
-                errors = data.get('errors') or []
-                warnings = data.get('warnings') or []
-                err_msg = ', '.join(errors + warnings)
-                return None, f"Помилка: {err_msg}"
+    data = await nova_poshta.call("InternetDocument", "save", method_properties)
+    if not data.get('success'):
+        errors = data.get('errors') or []
+        warnings = data.get('warnings') or []
+        err_msg = ', '.join(errors + warnings)
+        return None, f"Помилка: {err_msg}"
 
-            doc_info = data.get('data', [])
-            if not doc_info:
-                return None, "Відповідь пуста, документ не створено."
+    doc_info = data.get('data', [])
+    if not doc_info:
+        return None, "Відповідь пуста, документ не створено."
 
-            doc = doc_info[0]
-            ttn = doc.get('IntDocNumber')
-            if not ttn:
-                return None, "Не вдалося отримати IntDocNumber."
-            return ttn, None
+    doc = doc_info[0]
+    ttn = doc.get('IntDocNumber')
+    if not ttn:
+        return None, "Не вдалося отримати IntDocNumber."
+    return ttn, None
 
 
 # ======================================================================
 async def main():
     keep_alive()
     await db.init_db()  # Создаём таблицы, если их нет
+    await ensure_catalog_synced()  # Таблицы каталога догоняют products.json
+    await photo_cache.load()  # file_id уже загруженных в Telegram изображений
+    await nova_poshta.start()  # Общая HTTP-сессия для API Новой Почты
 
-    # Сначала запускаем фоновую задачу
+    # Сначала запускаем фоновые задачи
     asyncio.create_task(auto_check_nova_poshta())
     logger.info("Фоновая задача auto_check_nova_poshta запущена.")
+    asyncio.create_task(background_task())
+    logger.info("Фоновая задача для оновлення продуктів запущена.")
+    asyncio.create_task(archive_orders_task())
+    logger.info("Фоновая задача архівації замовлень запущена.")
 
     # Теперь - polling (он заблокирует выполнение дальше, пока бот не остановится)
-    await dp.start_polling(bot, skip_updates=True)
+    try:
+        await dp.start_polling(bot, skip_updates=True)
+    finally:
+        await nova_poshta.close()
+        await db.close_db()  # Закрываем пул соединений с БД
 
 
 if __name__ == '__main__':